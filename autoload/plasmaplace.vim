@@ -60,8 +60,17 @@ function! plasmaplace#ch_get_id(ch) abort
   endif
 endfunction
 
+" the daemon runs inside Vim when the channel is "in_process"
+function! s:is_in_process(ch) abort
+  return type(a:ch) == v:t_string && a:ch ==# "in_process"
+endfunction
+
 function! plasmaplace#send_cmd(ch, cmd, timeout) abort
-  if has("nvim")
+  if s:is_in_process(a:ch)
+    let data = json_encode(a:cmd)
+    return py3eval("plasmaplace_inprocess.request(vim.eval('data'), "
+        \ . a:timeout . ")")
+  elseif has("nvim")
     let msg = Plasmaplace_nvim_send_cmd(a:ch, a:cmd, a:timeout)
     if has_key(msg, "timeout")
       throw "plasmaplace: send_cmd timed out"
@@ -77,12 +86,31 @@ function! plasmaplace#send_cmd(ch, cmd, timeout) abort
   endif
 endfunction
 
+" like send_cmd, but returns right away and the reply is handed to
+" plasmaplace#_job_callback whenever it arrives
+function! plasmaplace#send_cmd_async(ch, cmd) abort
+  if s:is_in_process(a:ch)
+    let data = json_encode(a:cmd)
+    call py3eval("plasmaplace_inprocess.send(vim.eval('data'))")
+  elseif has("nvim")
+    let msg = Plasmaplace_nvim_send_cmd_async(a:ch, a:cmd)
+    if has_key(msg, "dead")
+      call plasmaplace#_close_callback(a:ch)
+    endif
+  else
+    call ch_sendexpr(a:ch, a:cmd, {"callback": "plasmaplace#_job_callback"})
+  endif
+endfunction
+
 """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 " vim buffer and window util functions
 """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 function! plasmaplace#get_buffer_num_lines(buffer) abort
-  let numlines = py3eval('len(vim.buffers[' . a:buffer . '])')
-  return numlines
+  let info = getbufinfo(a:buffer)
+  if !empty(info) && has_key(info[0], "linecount")
+    return info[0]["linecount"]
+  endif
+  return py3eval('len(vim.buffers[' . a:buffer . '])')
 endfunction
 
 function! plasmaplace#get_win_pos(winnr)
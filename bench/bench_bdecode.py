@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark comparing the byte-at-a-time legacy bdecode() with the
+buffered, incremental BDecoder on a local socket pair.
+
+    python3 bench/bench_bdecode.py [--repeat N]
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "python"))
+
+from plasmaplace_utils import bencode, BDecoder  # noqa: E402
+from plasmaplace_scraps import bdecode as legacy_bdecode  # noqa: E402
+
+
+def large_messages(count=4, size=1024 * 1024):
+    line = "(:key \"value\" 12345 [1 2 3] {:a 1})\n"
+    value = (line * (size // len(line) + 1))[:size]
+    msgs = []
+    for i in range(count):
+        msgs.append({"id": "msg-%d" % i, "session": "s", "value": value, "ns": "user"})
+    return msgs
+
+
+def small_messages(count=20000):
+    msgs = []
+    for i in range(count):
+        msgs.append({"id": "msg-%d" % i, "session": "s", "out": "line %d\n" % i})
+        if i % 10 == 0:
+            msgs.append({"id": "msg-%d" % i, "session": "s", "status": ["done"]})
+    return msgs
+
+
+def _run(payload, count, decode_all):
+    a, b = socket.socketpair()
+
+    def writer():
+        a.sendall(payload)
+        a.close()
+
+    t = threading.Thread(target=writer, daemon=True)
+    start = time.perf_counter()
+    t.start()
+    decoded = decode_all(b, count)
+    elapsed = time.perf_counter() - start
+    t.join()
+    b.close()
+    assert decoded == count, (decoded, count)
+    return elapsed
+
+
+def decode_legacy(sock, count):
+    n = 0
+    for _ in range(count):
+        legacy_bdecode(sock)
+        n += 1
+    return n
+
+
+def decode_buffered(sock, count):
+    decoder = BDecoder(sock)
+    n = 0
+    for _ in range(count):
+        decoder.read()
+        n += 1
+    return n
+
+
+def bench(name, msgs, repeat):
+    payload = b"".join(map(bencode, msgs))
+    mb = len(payload) / (1024 * 1024)
+    print("%s: %d messages, %.2f MiB" % (name, len(msgs), mb))
+    results = {}
+    for label, f in (("legacy", decode_legacy), ("buffered", decode_buffered)):
+        best = min(_run(payload, len(msgs), f) for _ in range(repeat))
+        results[label] = best
+        print(
+            "  %-9s %8.3f s  %8.1f MiB/s  %10.0f msg/s"
+            % (label, best, mb / best, len(msgs) / best)
+        )
+    print("  speedup   %8.1fx" % (results["legacy"] / results["buffered"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    bench("large", large_messages(), args.repeat)
+    bench("many-small", small_messages(), args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+End to end benchmark of the plasmaplace daemon against the fake nREPL
+server. The daemon is driven over its stdin JSON protocol exactly like Vim
+does, and throughput and tail latency are reported per scenario.
+
+    python3 bench/bench_daemon.py [--scenario NAME ...] [--json FILE]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+from queue import Queue
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DAEMON_PATH = os.path.join(BENCH_DIR, "..", "python", "plasmaplace.py")
+
+sys.path.insert(0, BENCH_DIR)
+
+from fake_nrepl import Config, FakeNreplServer  # noqa: E402
+
+
+class DaemonClient:
+    """ Talks to a plasmaplace daemon the way Vim does. """
+
+    def __init__(self, port_file_path, cwd, timeout_ms=60000, options=None):
+        cmd = [sys.executable, DAEMON_PATH, port_file_path, "default", str(timeout_ms)]
+        # keeps the eval history of the benchmark out of the real one
+        env = dict(os.environ, XDG_DATA_HOME=cwd)
+        self.proc = subprocess.Popen(
+            cmd, cwd=cwd, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+        self.msg_id = 0
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.pending = {}
+        self.async_msgs = Queue()
+        t = threading.Thread(target=self._read_loop, daemon=True)
+        t.start()
+        self.request(["init", options or {}])
+
+    def _read_loop(self):
+        for line in self.proc.stdout:
+            msg_id, msg = json.loads(line)
+            if msg_id == 0:
+                self.async_msgs.put(msg)
+                continue
+            with self.lock:
+                q = self.pending.pop(msg_id, None)
+            if q is not None:
+                q.put(msg)
+
+    def send(self, cmd):
+        with self.lock:
+            self.msg_id += 1
+            msg_id = self.msg_id
+            q = self.pending[msg_id] = Queue()
+        data = json.dumps([msg_id, cmd]) + "\n"
+        with self.write_lock:
+            self.proc.stdin.write(data.encode("utf-8"))
+            self.proc.stdin.flush()
+        return q
+
+    def request(self, cmd, timeout=120):
+        """ Returns (reply, seconds) """
+        start = time.perf_counter()
+        reply = self.send(cmd).get(timeout=timeout)
+        return reply, time.perf_counter() - start
+
+    def close(self):
+        try:
+            self.send(["exit"])
+            self.proc.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.proc.kill()
+
+
+class Result:
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.wall = 0.0
+
+    def percentile(self, p):
+        xs = sorted(self.latencies)
+        if not xs:
+            return 0.0
+        idx = min(len(xs) - 1, max(0, int(round(p / 100.0 * len(xs))) - 1))
+        return xs[idx]
+
+    def to_dict(self):
+        n = len(self.latencies)
+        return {
+            "name": self.name,
+            "ops": n,
+            "wall_s": self.wall,
+            "ops_per_s": n / self.wall if self.wall else 0.0,
+            "p50_ms": self.percentile(50) * 1000,
+            "p95_ms": self.percentile(95) * 1000,
+            "p99_ms": self.percentile(99) * 1000,
+            "max_ms": max(self.latencies) * 1000 if n else 0.0,
+        }
+
+    def report(self):
+        d = self.to_dict()
+        print(
+            "%-22s %6d ops %9.1f ops/s  p50 %8.2fms  p95 %8.2fms  p99 %8.2fms  "
+            "max %8.2fms"
+            % (
+                d["name"],
+                d["ops"],
+                d["ops_per_s"],
+                d["p50_ms"],
+                d["p95_ms"],
+                d["p99_ms"],
+                d["max_ms"],
+            )
+        )
+
+
+def _timed_loop(result, n, f):
+    start = time.perf_counter()
+    for _ in range(n):
+        _, latency = f()
+        result.latencies.append(latency)
+    result.wall = time.perf_counter() - start
+    return result
+
+
+def small_evals(env, n):
+    client = env.client()
+    code = "(+ 1 2)"
+    return _timed_loop(
+        Result("small-evals"), n, lambda: client.request(["eval", "'user", code])
+    )
+
+
+def concurrent_evals(env, n, concurrency=8):
+    client = env.client()
+    result = Result("concurrent-evals")
+    start = time.perf_counter()
+    done = 0
+    while done < n:
+        batch = min(concurrency, n - done)
+        sent = []
+        for _ in range(batch):
+            t0 = time.perf_counter()
+            sent.append((t0, client.send(["eval", "'user", "(+ 1 2)"])))
+        for t0, q in sent:
+            q.get(timeout=120)
+            result.latencies.append(time.perf_counter() - t0)
+        done += batch
+    result.wall = time.perf_counter() - start
+    return result
+
+
+def huge_output(env, n, size=8 * 1024 * 1024):
+    client = env.client()
+    code = "(fake/out %d)" % (size,)
+    result = Result("huge-output-%dMiB" % (size // (1024 * 1024),))
+    return _timed_loop(result, n, lambda: client.request(["eval", "'user", code]))
+
+
+def huge_value(env, n, size=8 * 1024 * 1024):
+    client = env.client()
+    code = "(fake/value %d)" % (size,)
+    result = Result("huge-value-%dMiB" % (size // (1024 * 1024),))
+    return _timed_loop(result, n, lambda: client.request(["eval", "'user", code]))
+
+
+def exception(env, n):
+    client = env.client()
+    return _timed_loop(
+        Result("exception"),
+        n,
+        lambda: client.request(["eval", "'user", "(fake/throw)"]),
+    )
+
+
+def stacktrace(env, n):
+    client = env.client()
+    client.request(["eval", "'user", "(fake/throw)"])
+    return _timed_loop(
+        Result("stacktrace"), n, lambda: client.request(["stacktrace", False])
+    )
+
+
+def doc_lookups(env, n):
+    client = env.client()
+    return _timed_loop(
+        Result("doc"), n, lambda: client.request(["doc", "'user", "map"])
+    )
+
+
+def with_idle_daemons(env, n, daemons=8):
+    """ small evals while other daemons keep their connections alive """
+    for _ in range(daemons):
+        env.client()
+    result = small_evals(env, n)
+    result.name = "evals+%d-idle-daemons" % (daemons,)
+    return result
+
+
+SCENARIOS = {
+    "small-evals": (small_evals, 500),
+    "concurrent-evals": (concurrent_evals, 500),
+    "huge-output": (huge_output, 5),
+    "huge-value": (huge_value, 5),
+    "exception": (exception, 200),
+    "stacktrace": (stacktrace, 200),
+    "doc": (doc_lookups, 500),
+    "idle-daemons": (with_idle_daemons, 200),
+}
+
+
+class Env:
+    """ A fake nREPL server plus the daemons started against it. """
+
+    def __init__(self, config, options):
+        self.dir = tempfile.mkdtemp(prefix="plasmaplace-bench-")
+        self.port_file_path = os.path.join(self.dir, ".nrepl-port")
+        self.server = FakeNreplServer(config).start()
+        self.server.write_port_file(self.port_file_path)
+        self.options = options
+        self.clients = []
+
+    def client(self):
+        c = DaemonClient(self.port_file_path, self.dir, options=self.options)
+        self.clients.append(c)
+        return c
+
+    def close(self):
+        for c in self.clients:
+            c.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS))
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply op counts")
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--stream", action="store_true", help="stream eval output")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    config = Config(latency_ms=args.latency_ms)
+    options = {"stream_output": 1 if args.stream else 0}
+    results = []
+    for name in args.scenario or list(SCENARIOS):
+        f, n = SCENARIOS[name]
+        env = Env(config, options)
+        try:
+            result = f(env, max(1, int(n * args.scale)))
+        finally:
+            env.close()
+        result.report()
+        results.append(result.to_dict())
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
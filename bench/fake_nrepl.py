@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+A scriptable stand-in for an nREPL server, good enough to drive the
+plasmaplace daemon without a JVM. It speaks bencode over TCP and implements
+clone, ls-sessions, eval, close and interrupt.
+
+Evaluation understands a few special forms, everything else evaluates to a
+value of --value-size bytes (or nil when that is 0):
+
+    (in-ns 'foo.bar)       switch the session namespace
+    (fake/out N)           print N bytes of output in --chunk-size chunks
+    (fake/value N)         evaluate to a value of N bytes
+    (fake/sleep MS)        take MS milliseconds, can be interrupted
+    (fake/throw)           fail with an exception, *e returns a stack trace
+                           of --trace-frames frames
+
+    python3 bench/fake_nrepl.py --port-file .nrepl-port
+"""
+import os
+import re
+import sys
+import uuid
+import socket
+import argparse
+import threading
+from queue import Queue
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "python"))
+
+from plasmaplace_utils import bencode, BDecoder  # noqa: E402
+
+
+class Config:
+    def __init__(
+        self,
+        latency_ms=0,
+        value_size=0,
+        chunk_size=4096,
+        chunk_delay_ms=0,
+        trace_frames=200,
+    ):
+        self.latency_ms = latency_ms
+        self.value_size = value_size
+        self.chunk_size = chunk_size
+        self.chunk_delay_ms = chunk_delay_ms
+        self.trace_frames = trace_frames
+
+
+def _filler(n):
+    line = "(:fake \"data\" 12345 [1 2 3] {:a 1})\n"
+    return (line * (n // len(line) + 1))[:n]
+
+
+def _stack_trace(frames):
+    lines = [
+        "#error {",
+        ' :cause "Divide by zero"',
+        " :via",
+        " [{:type java.lang.ArithmeticException",
+        '   :message "Divide by zero"}]',
+        " :trace",
+        " [",
+    ]
+    for i in range(frames):
+        if i % 3 == 0:
+            frame = '  [user$eval%d invokeStatic "NO_SOURCE_FILE" %d]' % (i, i)
+        else:
+            frame = '  [clojure.lang.Compiler eval "Compiler.java" %d]' % (7000 + i)
+        lines.append(frame)
+    lines[-1] += "]}"
+    return "\n".join(lines)
+
+
+class Session:
+    """ Evaluations on one session run one after another, like nREPL. """
+
+    def __init__(self, server, session_id):
+        self.server = server
+        self.id = session_id
+        self.ns = "user"
+        self.queue = Queue()
+        self.current = None
+        self.interrupted = threading.Event()
+        self.last_exception = False
+        t = threading.Thread(target=self._loop, daemon=True)
+        t.start()
+
+    def _loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            conn, msg = item
+            self.current = msg.get("id")
+            self.interrupted.clear()
+            original_ns = self.ns
+            try:
+                self.server.eval(conn, self, msg)
+            finally:
+                self.current = None
+                if "ns" in msg:
+                    # like interruptible-eval since nREPL 0.6
+                    self.ns = original_ns
+
+
+class Connection:
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.lock = threading.Lock()
+
+    def send(self, msg):
+        data = bencode(msg)
+        with self.lock:
+            self.sock.sendall(data)
+
+
+class FakeNreplServer:
+    def __init__(self, config=None, host="localhost", port=0):
+        self.config = config or Config()
+        self.sessions = {}
+        self.namespaces = {"user", "clojure.core"}
+        self.lock = threading.Lock()
+        self.ops = {}
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(64)
+        self.port = self.sock.getsockname()[1]
+
+    def write_port_file(self, path):
+        with open(path, "w") as f:
+            f.write(str(self.port))
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever, daemon=True)
+        t.start()
+        return self
+
+    def serve_forever(self):
+        while True:
+            sock, _ = self.sock.accept()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = Connection(self, sock)
+            t = threading.Thread(target=self._handle, args=(conn,), daemon=True)
+            t.start()
+
+    def _count(self, op):
+        with self.lock:
+            self.ops[op] = self.ops.get(op, 0) + 1
+
+    def _handle(self, conn):
+        try:
+            for msg in BDecoder(conn.sock):
+                self._count(msg.get("op"))
+                self.dispatch(conn, msg)
+        except (OSError, EOFError):
+            pass
+
+    def _reply(self, conn, msg, **kwargs):
+        reply = {"id": msg.get("id", "")}
+        if "session" in msg:
+            reply["session"] = msg["session"]
+        reply.update(kwargs)
+        conn.send(reply)
+
+    def dispatch(self, conn, msg):
+        op = msg.get("op")
+        if op == "clone":
+            session = Session(self, str(uuid.uuid4()))
+            with self.lock:
+                self.sessions[session.id] = session
+            new_session = {"new-session": session.id, "status": ["done"]}
+            self._reply(conn, msg, **new_session)
+        elif op == "ls-sessions":
+            with self.lock:
+                sessions = list(self.sessions)
+            self._reply(conn, msg, sessions=sessions, status=["done"])
+        elif op == "close":
+            with self.lock:
+                session = self.sessions.pop(msg.get("session"), None)
+            if session is not None:
+                session.queue.put(None)
+            self._reply(conn, msg, status=["session-closed", "done"])
+        elif op == "interrupt":
+            session = self.sessions.get(msg.get("session"))
+            if session is None or session.current is None:
+                self._reply(conn, msg, status=["session-idle", "done"])
+            elif session.current != msg.get("interrupt-id", session.current):
+                self._reply(conn, msg, status=["interrupt-id-mismatch", "done"])
+            else:
+                session.interrupted.set()
+                self._reply(conn, msg, status=["done"])
+        elif op == "eval":
+            session = self.sessions.get(msg.get("session"))
+            if session is None:
+                # ephemeral session
+                session = Session(self, str(uuid.uuid4()))
+                session.queue.put((conn, msg))
+                session.queue.put(None)
+            else:
+                session.queue.put((conn, msg))
+        else:
+            self._reply(conn, msg, status=["unknown-op", "done", "error"])
+
+    def _sleep(self, session, seconds):
+        """ Returns True when interrupted """
+        return session.interrupted.wait(seconds)
+
+    def eval(self, conn, session, msg):
+        config = self.config
+        code = msg.get("code", "").strip()
+        ns = msg.get("ns")
+        if ns is not None:
+            if ns not in self.namespaces:
+                status = ["namespace-not-found", "done", "error"]
+                self._reply(conn, msg, ns=ns, status=status)
+                return
+            session.ns = ns
+        if config.latency_ms and self._sleep(session, config.latency_ms / 1000.0):
+            return self._interrupted(conn, msg)
+
+        m = re.match(r"^\(in-ns\s+'([^\s)]+)\)$", code)
+        if m:
+            session.ns = m.group(1)
+            self.namespaces.add(session.ns)
+            value = "#namespace[%s]" % (session.ns,)
+            self._reply(conn, msg, value=value, ns=session.ns)
+        elif code.startswith("(fake/out"):
+            remaining = int(code[len("(fake/out"):-1])
+            while remaining > 0:
+                n = min(remaining, config.chunk_size)
+                self._reply(conn, msg, out=_filler(n))
+                remaining -= n
+                delay = config.chunk_delay_ms / 1000.0
+                if delay and self._sleep(session, delay):
+                    return self._interrupted(conn, msg)
+            self._reply(conn, msg, value="nil", ns=session.ns)
+        elif code.startswith("(fake/value"):
+            n = int(code[len("(fake/value"):-1])
+            self._reply(conn, msg, value=_filler(n), ns=session.ns)
+        elif code.startswith("(fake/sleep"):
+            ms = int(code[len("(fake/sleep"):-1])
+            if self._sleep(session, ms / 1000.0):
+                return self._interrupted(conn, msg)
+            self._reply(conn, msg, value="nil", ns=session.ns)
+        elif code == "(fake/throw)":
+            session.last_exception = True
+            err = (
+                "Execution error (ArithmeticException) at user/eval1 (REPL:1).\n"
+                "Divide by zero\n"
+            )
+            self._reply(conn, msg, err=err)
+            ex = "class java.lang.ArithmeticException"
+            self._reply(conn, msg, ex=ex, status=["eval-error"], **{"root-ex": ex})
+        elif code == "*e":
+            if session.last_exception:
+                value = _stack_trace(config.trace_frames)
+            else:
+                value = "nil"
+            self._reply(conn, msg, value=value, ns=session.ns)
+        elif config.value_size:
+            self._reply(conn, msg, value=_filler(config.value_size), ns=session.ns)
+        else:
+            self._reply(conn, msg, value="nil", ns=session.ns)
+        self._reply(conn, msg, status=["done"])
+
+    def _interrupted(self, conn, msg):
+        self._reply(conn, msg, status=["interrupted"])
+        self._reply(conn, msg, status=["done"])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--port-file", default=".nrepl-port")
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--value-size", type=int, default=0)
+    parser.add_argument("--chunk-size", type=int, default=4096)
+    parser.add_argument("--chunk-delay-ms", type=float, default=0)
+    parser.add_argument("--trace-frames", type=int, default=200)
+    args = parser.parse_args()
+    config = Config(
+        latency_ms=args.latency_ms,
+        value_size=args.value_size,
+        chunk_size=args.chunk_size,
+        chunk_delay_ms=args.chunk_delay_ms,
+        trace_frames=args.trace_frames,
+    )
+    server = FakeNreplServer(config, port=args.port)
+    server.write_port_file(args.port_file)
+    print("fake nREPL server listening on port %d" % (server.port,))
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
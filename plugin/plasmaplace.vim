@@ -21,6 +21,65 @@ endif
 if !exists("g:plasmaplace_command_timeout_ms")
   let g:plasmaplace_command_timeout_ms = 5000
 endif
+if !exists("g:plasmaplace_interrupt_on_timeout")
+  let g:plasmaplace_interrupt_on_timeout = 0
+endif
+" stop waiting for an evaluation that nREPL has not replied to in this long,
+" 0 waits forever
+if !exists("g:plasmaplace_request_timeout_s")
+  let g:plasmaplace_request_timeout_s = 600
+endif
+if !exists("g:plasmaplace_cljfmt_incremental")
+  let g:plasmaplace_cljfmt_incremental = 1
+endif
+if !exists("g:plasmaplace_stream_output")
+  let g:plasmaplace_stream_output = 1
+endif
+if !exists("g:plasmaplace_stream_flush_ms")
+  let g:plasmaplace_stream_flush_ms = 100
+endif
+if !exists("g:plasmaplace_output_limit_bytes")
+  let g:plasmaplace_output_limit_bytes = 1048576
+endif
+if !exists("g:plasmaplace_session_lanes")
+  let g:plasmaplace_session_lanes = 1
+endif
+if !exists("g:plasmaplace_parallel_tests")
+  let g:plasmaplace_parallel_tests = 0
+endif
+if !exists("g:plasmaplace_parallel_test_sessions")
+  let g:plasmaplace_parallel_test_sessions = 4
+endif
+if !exists("g:plasmaplace_reload_dependents")
+  let g:plasmaplace_reload_dependents = 1
+endif
+if !exists("g:plasmaplace_reload_debounce_ms")
+  let g:plasmaplace_reload_debounce_ms = 200
+endif
+if !exists("g:plasmaplace_reload_changed_forms")
+  let g:plasmaplace_reload_changed_forms = 0
+endif
+if !exists("g:plasmaplace_omnifunc")
+  let g:plasmaplace_omnifunc = 1
+endif
+if !exists("g:plasmaplace_scratch_max_entries")
+  let g:plasmaplace_scratch_max_entries = 0
+endif
+if !exists("g:plasmaplace_in_process")
+  let g:plasmaplace_in_process = 0
+endif
+if !exists("g:plasmaplace_in_process_poll_ms")
+  let g:plasmaplace_in_process_poll_ms = 20
+endif
+if !exists("g:plasmaplace_shared_daemon")
+  let g:plasmaplace_shared_daemon = 0
+endif
+if !exists("g:plasmaplace_persistent_daemon")
+  let g:plasmaplace_persistent_daemon = 0
+endif
+if !exists("g:plasmaplace_daemon_idle_timeout_s")
+  let g:plasmaplace_daemon_idle_timeout_s = 1800
+endif
 
 """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 " internal vars
@@ -28,12 +87,23 @@ endif
 let s:script_path = expand('<sfile>:p:h')
 let s:python_dir = fnamemodify(expand("<sfile>"), ":p:h:h") . "/python"
 let s:daemon_path = s:python_dir . "/plasmaplace.py"
+let s:attach_path = s:python_dir . "/plasmaplace_attach.py"
 let s:repl_scratch_buffers = {}
+" project key -> first line of every entry in the scratch buffer
+let s:scratch_entries = {}
+let s:separator = repeat(";", 80)
 let s:jobs = {}
 let s:channels = {}
 let s:channel_id_to_project_key = {}
+" the one daemon every project uses when g:plasmaplace_shared_daemon is set
+let s:shared_job = v:null
+" timer that hands replies of the in-process daemon to _job_callback
+let s:in_process_timer = v:null
 let s:last_eval_ns = ""
 let s:last_eval_form = ""
+" verbs whose reply the caller needs, everything else is sent asynchronously
+let s:sync_verbs =
+    \ ["init", "exit", "cljfmt", "cljfmt_incremental", "buffer_info", "complete"]
 
 """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 " utils
@@ -79,8 +149,12 @@ endfun
 
 function! plasmaplace#_job_callback(ch, msg) abort
   try
-    let ch_id = plasmaplace#ch_get_id(a:ch)
-    let project_key = s:channel_id_to_project_key[ch_id]
+    if type(a:msg) == v:t_dict && has_key(a:msg, "project_key")
+      let project_key = a:msg["project_key"]
+    else
+      let ch_id = plasmaplace#ch_get_id(a:ch)
+      let project_key = s:channel_id_to_project_key[ch_id]
+    endif
     call s:handle_message(project_key, a:msg)
   catch /E716/
     " No-op if data isn't ready
@@ -89,11 +163,21 @@ endfunction
 
 function! plasmaplace#_close_callback(ch) abort
     let ch_id = plasmaplace#ch_get_id(a:ch)
-    let project_key = s:channel_id_to_project_key[ch_id]
-    call remove(s:channel_id_to_project_key, ch_id)
-    call remove(s:jobs, project_key)
-    call remove(s:channels, project_key)
-    call s:echo_warning(printf("plasmaplace daemon died for project: %s", project_key))
+    if has_key(s:channel_id_to_project_key, ch_id)
+      call remove(s:channel_id_to_project_key, ch_id)
+    endif
+    if s:shared_job isnot v:null
+        \ && plasmaplace#ch_get_id(s:shared_channel()) == ch_id
+      let s:shared_job = v:null
+    endif
+    " a shared daemon takes every project down with it
+    for [project_key, ch] in items(s:channels)
+      if plasmaplace#ch_get_id(ch) == ch_id
+        call remove(s:jobs, project_key)
+        call remove(s:channels, project_key)
+        call s:echo_warning(printf("plasmaplace daemon died for project: %s", project_key))
+      endif
+    endfor
 endfunction
 
 function! s:is_invalid_response(msg) abort
@@ -115,6 +199,9 @@ endfunction
 function! s:handle_message(project_key, msg) abort
   if s:is_invalid_response(a:msg)
     call s:echo_warning("vim-plasmaplace REPL command timed out")
+  elseif has_key(a:msg, "stream_done")
+    " output was already appended as it arrived
+    redraw
   elseif has_key(a:msg, "value")
     return a:msg["value"]
   elseif has_key(a:msg, "lines")
@@ -123,6 +210,9 @@ function! s:handle_message(project_key, msg) abort
       let skip_center = a:msg["skip_center"]
     endif
     call s:append_lines_to_scratch(a:project_key, a:msg["lines"], skip_center)
+    if has_key(a:msg, "stream")
+      redraw
+    endif
   elseif has_key(a:msg, "popup")
     let popup_width = 90
     if has("nvim")
@@ -174,12 +264,96 @@ function! s:append_lines_to_scratch(project_key, lines, skip_center) abort
   let scratch_bufnr = s:repl_scratch_buffers[a:project_key]
   let top_line_num = plasmaplace#get_buffer_num_lines(scratch_bufnr) + 1
   call appendbufline(scratch_bufnr, "$", a:lines)
+  if g:plasmaplace_scratch_max_entries > 0
+      \ && !empty(a:lines) && a:lines[0] ==# s:separator
+    let top_line_num = s:trim_scratch(a:project_key, scratch_bufnr, top_line_num)
+  endif
 
   if !a:skip_center
     call plasmaplace#center_scratch_buf(scratch_bufnr, top_line_num)
   endif
 endfunction
 
+" keeps the last g:plasmaplace_scratch_max_entries entries, every evaluation
+" is in the history anyway, returns where the new entry starts now
+function! s:trim_scratch(project_key, bufnr, top_line_num) abort
+  let entries = get(s:scratch_entries, a:project_key, [])
+  call add(entries, a:top_line_num)
+  let extra = len(entries) - g:plasmaplace_scratch_max_entries
+  let top_line_num = a:top_line_num
+  if extra > 0
+    let cut = entries[extra] - 1
+    if cut < plasmaplace#get_buffer_num_lines(a:bufnr)
+      silent call deletebufline(a:bufnr, 1, cut)
+      let entries = map(entries[extra :], 'v:val - cut')
+      let top_line_num -= cut
+    else
+      " the buffer was edited by hand
+      let entries = [a:top_line_num]
+    endif
+  endif
+  let s:scratch_entries[a:project_key] = entries
+  return top_line_num
+endfunction
+
+function! s:start_job(cmd) abort
+  if has("nvim")
+    return Plasmaplace_nvim_start_job(a:cmd)
+  endif
+  let options = {
+      \ "mode": "json",
+      \ "cwd": plasmaplace#get_project_path(),
+      \ "callback": "plasmaplace#_job_callback",
+      \ "close_cb": "plasmaplace#_close_callback",
+      \ }
+  if 1
+    let options["err_mode"] = "raw"
+    let options["err_io"] = "file"
+    let options["err_name"] = "/tmp/plasmaplace.error.log"
+  else
+    let options["err_mode"] = "raw"
+    let options["err_io"] = "null"
+  endif
+  return job_start(a:cmd, options)
+endfunction
+
+" Vim 8 can run the daemon in its own python3
+function! s:in_process() abort
+  return g:plasmaplace_in_process && !has("nvim")
+endfunction
+
+function! s:poll_in_process(timer) abort
+  for msg in py3eval("plasmaplace_inprocess.poll()")
+    call plasmaplace#_job_callback(v:null, msg)
+  endfor
+endfunction
+
+function! s:start_in_process() abort
+  if s:in_process_timer isnot v:null
+    return
+  endif
+  execute "python3 import sys; sys.path.insert(0, " . string(s:python_dir) . ")"
+  python3 import plasmaplace_inprocess
+  python3 plasmaplace_inprocess.start()
+  let s:in_process_timer = timer_start(g:plasmaplace_in_process_poll_ms,
+      \ function("s:poll_in_process"), {"repeat": -1})
+endfunction
+
+function! s:shared_channel() abort
+  if has("nvim")
+    return s:shared_job
+  endif
+  return job_getchannel(s:shared_job)
+endfunction
+
+" commands for a shared daemon say which project they are for
+function! s:wrap_cmd(project_key, cmd) abort
+  if g:plasmaplace_shared_daemon || s:in_process()
+    return {"project_key": a:project_key, "cmd": a:cmd}
+  endif
+  return a:cmd
+endfunction
+
 function! s:create_or_get_job(project_key) abort
   if has_key(s:jobs, a:project_key)
     return s:jobs[a:project_key]
@@ -201,39 +375,55 @@ function! s:create_or_get_job(project_key) abort
     throw "plasmaplace: could not determine nREPL port file"
   endif
 
-  let cmd =
-      \ ["python3", s:daemon_path,
-      \ port_file_path, project_type, g:plasmaplace_command_timeout_ms]
-  if has("nvim")
-    let job = Plasmaplace_nvim_start_job(cmd)
-  else
-    let options = {
-        \ "mode": "json",
-        \ "cwd": plasmaplace#get_project_path(),
-        \ "callback": "plasmaplace#_job_callback",
-        \ "close_cb": "plasmaplace#_close_callback",
-        \ }
-    if 1
-      let options["err_mode"] = "raw"
-      let options["err_io"] = "file"
-      let options["err_name"] = "/tmp/plasmaplace.error.log"
-    else
-      let options["err_mode"] = "raw"
-      let options["err_io"] = "null"
+  if s:in_process()
+    call s:start_in_process()
+    let job = "in_process"
+  elseif g:plasmaplace_shared_daemon
+    if s:shared_job is v:null
+      let s:shared_job = s:start_job(["python3", s:daemon_path, "--shared"])
     endif
-    let job = job_start(cmd, options)
+    let job = s:shared_job
+  elseif g:plasmaplace_persistent_daemon
+    " attaches to the daemon a previous editor left running, if any
+    let cmd =
+        \ ["python3", s:attach_path,
+        \ port_file_path, project_type, g:plasmaplace_command_timeout_ms,
+        \ g:plasmaplace_daemon_idle_timeout_s]
+    let job = s:start_job(cmd)
+  else
+    let cmd =
+        \ ["python3", s:daemon_path,
+        \ port_file_path, project_type, g:plasmaplace_command_timeout_ms]
+    let job = s:start_job(cmd)
   endif
   let s:jobs[a:project_key] = job
-  if has("nvim")
+  if has("nvim") || s:in_process()
     let ch = job
   else
     let ch = job_getchannel(job)
   endif
   let s:channels[a:project_key] = ch
-  let ch_id = plasmaplace#ch_get_id(ch)
-  let s:channel_id_to_project_key[ch_id] = a:project_key
+  if !g:plasmaplace_shared_daemon && !s:in_process()
+    let ch_id = plasmaplace#ch_get_id(ch)
+    let s:channel_id_to_project_key[ch_id] = a:project_key
+  endif
 
-  let msg = plasmaplace#send_cmd(ch, ["init"], g:plasmaplace_command_timeout_ms)
+  let options = {
+      \ "interrupt_on_timeout": g:plasmaplace_interrupt_on_timeout,
+      \ "request_timeout_s": g:plasmaplace_request_timeout_s,
+      \ "stream_output": g:plasmaplace_stream_output,
+      \ "stream_flush_ms": g:plasmaplace_stream_flush_ms,
+      \ "output_limit_bytes": g:plasmaplace_output_limit_bytes,
+      \ "session_lanes": g:plasmaplace_session_lanes,
+      \ }
+  if g:plasmaplace_shared_daemon || s:in_process()
+    let options["port_file_path"] = port_file_path
+    let options["project_type"] = project_type
+    let options["project_path"] = project_path
+    let options["timeout_ms"] = g:plasmaplace_command_timeout_ms
+  endif
+  let cmd = s:wrap_cmd(a:project_key, ["init", options])
+  let msg = plasmaplace#send_cmd(ch, cmd, g:plasmaplace_command_timeout_ms)
   call s:handle_message(a:project_key, msg)
 endfunction
 
@@ -243,11 +433,17 @@ function! s:repl(cmd) abort
   let job = s:create_or_get_job(project_key)
   let ch = s:channels[project_key]
 
+  let cmd = s:wrap_cmd(project_key, a:cmd)
+  if index(s:sync_verbs, a:cmd[0]) < 0
+    call plasmaplace#send_cmd_async(ch, cmd)
+    return
+  endif
+
   let timeout = g:plasmaplace_command_timeout_ms
-  if a:cmd[0] == "cljfmt"
+  if a:cmd[0] == "cljfmt" || a:cmd[0] == "cljfmt_incremental"
     let timeout = 8192
   endif
-  let msg = plasmaplace#send_cmd(ch, a:cmd, timeout)
+  let msg = plasmaplace#send_cmd(ch, cmd, timeout)
   return s:handle_message(project_key, msg)
 endfunction
 
@@ -288,6 +484,23 @@ function! plasmaplace#center_scratch_buf(scratch, top_line_num) abort
   endif
 endfunction
 
+" namespace of the current buffer, the daemon's project index is asked once
+" per buffer and the buffer text is parsed when it does not know
+function! s:ns() abort
+  if exists("b:plasmaplace_ns")
+    return b:plasmaplace_ns
+  endif
+  let path = expand("%:p")
+  if filereadable(path)
+    let info = s:repl(["buffer_info", path])
+    if type(info) == v:t_dict && type(get(info, "ns")) == v:t_string
+      let b:plasmaplace_ns = info["ns"]
+      return b:plasmaplace_ns
+    endif
+  endif
+  return plasmaplace#ns()
+endfunction
+
 """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 " operator
 """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
@@ -308,7 +521,7 @@ function! s:EvalMotion(type, ...) abort
     silent exe "normal! `[v`]y"
   endif
 
-  let ns = plasmaplace#quote(plasmaplace#ns())
+  let ns = plasmaplace#quote(s:ns())
   let s:last_eval_ns = ns
   let s:last_eval_form = @@
   call s:repl(["eval", s:last_eval_ns, s:last_eval_form])
@@ -330,7 +543,7 @@ function! s:Macroexpand(type, ...) abort
     silent exe "normal! `[v`]y"
   endif
 
-  let ns = plasmaplace#quote(plasmaplace#ns())
+  let ns = plasmaplace#quote(s:ns())
   call s:repl(["macroexpand", ns, @@])
 
   let &selection = sel_save
@@ -350,7 +563,7 @@ function! s:Macroexpand1(type, ...) abort
     silent exe "normal! `[v`]y"
   endif
 
-  let ns = plasmaplace#quote(plasmaplace#ns())
+  let ns = plasmaplace#quote(s:ns())
   call s:repl(["macroexpand1", ns, @@])
 
   let &selection = sel_save
@@ -379,7 +592,7 @@ function! s:Require(bang, echo, ns) abort
 
   let ns = a:ns
   if ns ==# ""
-    let ns = plasmaplace#ns()
+    let ns = s:ns()
   endif
   let ns = plasmaplace#quote(ns)
 
@@ -391,6 +604,53 @@ function! s:Require(bang, echo, ns) abort
   return ""
 endfunction
 
+" reloads the saved namespace and the ones that depend on it, saves close
+" together are reloaded in one go by the daemon
+function! s:ReloadOnSave() abort
+  if !g:plasmaplace_reload_dependents
+    return s:Require(0, 1, "")
+  endif
+  if expand("%:e") ==# "cljs" | return | endif
+  if expand("%") ==# "project.clj" | return | endif
+  if expand("%") ==# "linter.cljc" | return | endif
+
+  let project_path = plasmaplace#get_project_path()
+  if plasmaplace#get_project_type(project_path) == "shadow-cljs" | return | endif
+
+  if g:plasmaplace_reload_changed_forms
+    call s:repl(["reload_changed", expand("<afile>:p")])
+  else
+    call s:repl(["reload", expand("<afile>:p"), g:plasmaplace_reload_debounce_ms])
+  endif
+  return ""
+endfunction
+
+" evaluates only the forms of the file that changed since it was last loaded
+function! s:ReloadChanged() abort
+  call s:repl(["reload_changed", expand("%:p")])
+  return ""
+endfunction
+
+""""""""""""""""""""""""""""""""""""""""
+
+" completion candidates come from what the daemon caches for each namespace
+function! plasmaplace#omnifunc(findstart, base) abort
+  if a:findstart
+    let line = getline(".")[0 : col(".") - 2]
+    return match(line, '[[:alnum:]_?*!+/=<>.:''-]*$')
+  endif
+  try
+    let ns = plasmaplace#quote(s:ns())
+    let candidates = s:repl(["complete", ns, a:base])
+  catch
+    return []
+  endtry
+  if type(candidates) != v:t_list
+    return []
+  endif
+  return candidates
+endfunction
+
 """"""""""""""""""""""""""""""""""""""""
 
 function! s:Doc(symbol) abort
@@ -403,7 +663,7 @@ function! s:Doc(symbol) abort
   let symbol = substitute(symbol, '\\\*', "*", "g") " extra backslash not an error
   let symbol = substitute(symbol, '\\<', "<", "g")
   let symbol = substitute(symbol, '\\>', ">", "g")
-  let ns = plasmaplace#ns()
+  let ns = s:ns()
   let ns = plasmaplace#quote(ns)
   call s:repl(["doc", ns, symbol])
   return ''
@@ -441,6 +701,19 @@ function! s:RunTests(bang, count, ...) abort
     let test_ns = "clojure.test"
   endif
 
+  if g:plasmaplace_parallel_tests && test_ns ==# "clojure.test"
+    if a:count < 0
+      let pattern = a:0 ? join(a:000, '|') : ""
+      call s:repl(["run_tests_parallel", [], pattern,
+          \ g:plasmaplace_parallel_test_sessions])
+      return
+    elseif a:0 > 1 && empty(filter(copy(a:000), 'v:val =~# "/"'))
+      call s:repl(["run_tests_parallel", a:000, "",
+          \ g:plasmaplace_parallel_test_sessions])
+      return
+    endif
+  endif
+
   if a:count < 0
     if a:0
       let expr = [
@@ -451,10 +724,10 @@ function! s:RunTests(bang, count, ...) abort
       let expr = [printf('(%s/run-all-tests)', test_ns)]
     endif
   else
-    if a:0 && a:000 !=# [plasmaplace#ns()]
+    if a:0 && a:000 !=# [s:ns()]
       let args = a:000
     else
-      let args = [plasmaplace#ns()]
+      let args = [s:ns()]
       if a:count
         let pattern = '^\s*(def\k*\s\+\(\h\k*\)'
         let line = search(pattern, 'bcWn')
@@ -508,7 +781,35 @@ function! s:replace_buffer(content) abort
   endif
 endfunction
 
+" patches are [start, end, lines], 0-based, end exclusive and sorted by start
+function! s:apply_patches(patches) abort
+  for [first, last, lines] in reverse(copy(a:patches))
+    if len(lines) == last - first
+      call setline(first + 1, lines)
+    else
+      silent execute (first + 1) . "," . last . "delete _"
+      call append(first, lines)
+    endif
+  endfor
+endfunction
+
+function! s:CljfmtIncremental() abort
+  let contents = join(getline(1, '$'), "\n")
+  let patches = s:repl(["cljfmt_incremental", expand("%:p"), contents])
+  if type(patches) != v:t_list
+    return
+  endif
+  if len(patches) > 0
+    let l:curw = winsaveview()
+    call s:apply_patches(patches)
+    call winrestview(l:curw)
+  endif
+endfunction
+
 function! plasmaplace#Cljfmt() abort
+  if g:plasmaplace_cljfmt_incremental
+    return s:CljfmtIncremental()
+  endif
   let code = s:get_current_buffer_contents_as_string()
   let formatted_code = s:repl(["cljfmt", code])
 
@@ -527,15 +828,58 @@ function! s:Reconnect() abort
   let project_key = plasmaplace#get_project_key()
   if has_key(s:jobs, project_key)
     let job = s:jobs[project_key]
-    if has("nvim")
+    if g:plasmaplace_shared_daemon || s:in_process()
+      " only this project's connection, the daemon keeps serving the others
+      let cmd = s:wrap_cmd(project_key, ["exit"])
+      call plasmaplace#send_cmd(s:channels[project_key], cmd,
+          \ g:plasmaplace_command_timeout_ms)
+    elseif has("nvim")
       call Plasmaplace_nvim_stop_job(job)
     else
       call job_stop(job)
     endif
+    call remove(s:jobs, project_key)
+    call remove(s:channels, project_key)
   endif
   call s:create_or_get_job(project_key)
 endfunction
 
+function! s:Interrupt() abort
+  call s:repl(["interrupt"])
+  return ""
+endfunction
+
+function! s:More(handle) abort
+  call s:repl(["more", a:handle])
+  return ""
+endfunction
+
+function! s:Stacktrace(bang) abort
+  call s:repl(["stacktrace", a:bang])
+  return ""
+endfunction
+
+function! s:History(query) abort
+  call s:repl(["history", a:query])
+  return ""
+endfunction
+
+function! s:Recall(id) abort
+  call s:repl(["recall", a:id])
+  return ""
+endfunction
+
+function! s:Stats(bang) abort
+  call s:repl(["stats", a:bang])
+  return ""
+endfunction
+
+" stops a persistent daemon instead of only detaching from it
+function! s:Shutdown() abort
+  call s:repl(["shutdown"])
+  return ""
+endfunction
+
 function! s:DeleteOtherNreplSessions() abort
   call s:repl(["delete_other_nrepl_sessions"])
 endfunction
@@ -551,10 +895,21 @@ endf
 function! s:setup_commands() abort
   command! -buffer -bar Reconnect :exe s:Reconnect()
   command! -buffer -bar DeleteOtherNreplSessions :exe s:DeleteOtherNreplSessions()
+  command! -buffer -bar Interrupt :exe s:Interrupt()
+  command! -buffer -bar PlasmaplaceShutdown :exe s:Shutdown()
+  command! -buffer -bar -nargs=? PlasmaplaceMore :exe s:More(<q-args>)
+  command! -buffer -bar -bang PlasmaplaceStacktrace :exe s:Stacktrace(<bang>0)
+  command! -buffer -nargs=? PlasmaplaceHistory :exe s:History(<q-args>)
+  command! -buffer -bar -nargs=1 PlasmaplaceRecall :exe s:Recall(<q-args>)
+  command! -buffer -bar -bang PlasmaplaceStats :exe s:Stats(<bang>0)
 
   command! -buffer -bar -bang -nargs=? Require :exe s:Require(<bang>0, 1, <q-args>)
+  command! -buffer -bar ReloadChanged :exe s:ReloadChanged()
   command! -buffer -bar -nargs=1 Doc :exe s:Doc(<q-args>)
   setlocal keywordprg=:Doc
+  if g:plasmaplace_omnifunc
+    setlocal omnifunc=plasmaplace#omnifunc
+  endif
 
   command! -buffer -bar -bang -range=0 -nargs=* RunTests
         \ call s:RunTests(<bang>0, <line1> == 0 ? -1 : <count>, <f-args>)
@@ -591,6 +946,15 @@ function! s:setup_keybinds() abort
 endfunction
 
 function! s:cleanup_daemons() abort
+  if s:in_process_timer isnot v:null
+    python3 plasmaplace_inprocess.stop()
+    return
+  endif
+  if s:shared_job isnot v:null
+    call plasmaplace#send_cmd(s:shared_channel(), ["exit"],
+        \ g:plasmaplace_command_timeout_ms)
+    return
+  endif
   for [project_key, ch] in items(s:channels)
     call plasmaplace#send_cmd(ch, ["exit"], g:plasmaplace_command_timeout_ms)
   endfor
@@ -603,7 +967,9 @@ augroup plasmaplace
   autocmd FileType clojure call s:setup_commands()
   autocmd FileType clojure call s:setup_keybinds()
   autocmd VimLeave * call s:cleanup_daemons()
-  autocmd BufWritePost *.clj call s:Require(0, 1, "")
-  autocmd BufWritePost *.cljs call s:Require(0, 1, "")
-  autocmd BufWritePost *.cljc call s:Require(0, 1, "")
+  " the ns form may have changed
+  autocmd BufWritePost *.clj,*.cljs,*.cljc unlet! b:plasmaplace_ns
+  autocmd BufWritePost *.clj call s:ReloadOnSave()
+  autocmd BufWritePost *.cljs call s:ReloadOnSave()
+  autocmd BufWritePost *.cljc call s:ReloadOnSave()
 augroup END
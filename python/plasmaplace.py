@@ -9,82 +9,183 @@ import threading
 import atexit
 import time
 import queue
+import argparse
 import traceback
+from collections import deque
 
-from plasmaplace_utils import bencode, bdecode, get_shadow_primary_target
+from plasmaplace_utils import get_project_path
+from plasmaplace_index import get_index
 from plasmaplace_io import (
     _debug,
     EXIT_SIGNAL_QUEUE,
     TO_NREPL,
+    CONNECTIONS,
+    Connection,
+    add_connection,
+    remove_connection,
     to_vim,
-    read_nrepl_msg,
-    connect_to_nrepl_socket,
-    start_keepalive_loop
+    set_vim_output,
+    start_io_loops,
+    start_keepalive_loop,
 )
 import plasmaplace_repl_eval
-from plasmaplace_repl_eval import ReplEval
+from plasmaplace_repl_eval import ReplEval, TooBusy
 import plasmaplace_commands
+from plasmaplace_stats import STATS
 
-PROJECT_PATH = None
-PROJECT_TYPE = None
-TIMEOUT_MS = 4096
+# commands from Vim run concurrently on a pool of worker threads, replies are
+# matched back by msg_id
+MAX_WORKERS = 8
+COMMANDS = queue.Queue()
+# past this many waiting commands Vim is told to back off instead
+MAX_QUEUED_COMMANDS = 64
+BUSY_LINES = [";; plasmaplace is busy, try again in a moment or :Interrupt"]
+# these are handled on the stdin loop itself, in order, interrupt and stats
+# so that they do not wait behind the commands they are about
+SERIAL_VERBS = ("init", "exit", "shutdown", "interrupt", "stats")
+# verb -> lane its commands run in the order they came in on, one at a time
+# per project, everything else (lookups) runs as soon as a worker is free
+ORDERED_VERBS = {
+    "eval": "primary",
+    "require": "primary",
+    "reload": "primary",
+    "reload_changed": "primary",
+    "stacktrace": "primary",
+    "run_tests": "tests",
+    "run_tests_parallel": "tests",
+}
+# (project key, lane) -> commands waiting for the one that runs in it
+ORDERED_PENDING = {}
+ORDERED_LOCK = threading.Lock()
 
-EXISTING_SESSIONS = None
-ROOT_SESSION = None
+# what the daemon was started with when it serves a single project, so that
+# it can connect again after losing the connection
+DEFAULT_CONNECT_ARGS = None
+# sessions cloned next to the primary one so that tooling ops and tests do not
+# wait behind whatever the user is evaluating
+LANES = ("tooling", "tests")
+SHUTDOWN = threading.Event()
 
 
-def init(port_file_path, project_type, timeout_ms):
-    global PROJECT_TYPE
-    global TIMEOUT_MS
-    PROJECT_TYPE = project_type
-    TIMEOUT_MS = int(timeout_ms)
-    connect_to_nrepl_socket(port_file_path)
+def connect(key, port_file_path, project_type, project_path, timeout_ms):
+    conn = Connection(key, port_file_path, project_type, project_path, timeout_ms)
+    add_connection(conn)
+    return conn
 
 
-def get_existing_sessions(out):
-    global EXISTING_SESSIONS
+def get_existing_sessions(conn, out):
+    with STATS.timer("nrepl_rtt.ls-sessions"):
+        msg = ReplEval.request(conn, {"op": "ls-sessions"})
+    conn.existing_sessions = msg["sessions"]
+    # _debug(conn.existing_sessions)
+    out += [";; existing sessions: " + str(conn.existing_sessions)]
 
-    cmd = {"op": "ls-sessions"}
-    TO_NREPL.put(cmd)
-    msg = read_nrepl_msg()
-    EXISTING_SESSIONS = msg["sessions"]
-    # _debug(EXISTING_SESSIONS)
-    out += [";; existing sessions: " + str(EXISTING_SESSIONS)]
 
-
-def acquire_root_session(out):
-    global ROOT_SESSION
-
-    if ROOT_SESSION is not None:
+def acquire_root_session(conn, out):
+    if conn.root_session is not None:
         return
-    cmd = {"op": "clone"}
-    TO_NREPL.put(cmd)
-    msg = read_nrepl_msg()
-    ROOT_SESSION = msg["new-session"]
-    out += [";; current session: " + ROOT_SESSION]
+    with STATS.timer("nrepl_rtt.clone"):
+        msg = ReplEval.request(conn, {"op": "clone"})
+    conn.root_session = msg["new-session"]
+    conn.sessions["primary"] = conn.root_session
+    out += [";; current session: " + conn.root_session]
 
 
-def setup_repl(out):
-    global PROJECT_TYPE
-    global PROJECT_PATH
-    f = plasmaplace_commands.dispatcher["eval"]
+def acquire_lane_sessions(conn, out):
+    """ Lanes start out as copies of the primary session once it is set up """
+    for lane in LANES:
+        if lane in conn.sessions:
+            continue
+        ReplEval.clone_session(conn, lane)
+        if conn.project_type == "shadow-cljs":
+            code, _ = _setup_code(conn)
+            ReplEval(conn, code, silent=True, lane=lane)
+        out += [";; %s session: %s" % (lane, conn.sessions[lane])]
+
 
-    _debug("setup REPL: " + str(PROJECT_TYPE))
-    if PROJECT_TYPE == "shadow-cljs":
-        shadow_primary_target = get_shadow_primary_target(PROJECT_PATH)
+def _setup_code(conn):
+    """ Returns the code that readies a new session and what to tell Vim """
+    if conn.project_type == "shadow-cljs":
+        shadow_primary_target = get_index(conn.project_path).shadow_primary_target()
         if shadow_primary_target:
             code = "(shadow/nrepl-select %s)" % (shadow_primary_target)
-            f(None, code)
-            out += [";; (shadow/nrepl-select %s)" % (shadow_primary_target,)]
-        else:
-            out += [";; UNABLE TO SELECT NREPL primary TARGET"]
-            out += [";; DEFAULTING to (shadow/node-repl)"]
-            code = "(shadow/node-repl)"
-            f(None, code)
+            return code, [";; (shadow/nrepl-select %s)" % (shadow_primary_target,)]
+        out = [";; UNABLE TO SELECT NREPL primary TARGET"]
+        out += [";; DEFAULTING to (shadow/node-repl)"]
+        return "(shadow/node-repl)", out
+    code = "(in-ns user)"
+    return code, [code]
+
+
+def setup_repl(conn, out):
+    f = plasmaplace_commands.dispatcher["eval"]
+
+    _debug("setup REPL: " + str(conn.project_type))
+    code, lines = _setup_code(conn)
+    out += lines
+    f(conn, None, code)
+
+
+def connection_lost(conn):
+    ReplEval.abandon_all(conn)
+    conn.to_vim(0, {"lines": [";; nREPL connection lost, try :Reconnect"]})
+
+
+def _unwrap(msg):
+    """ A shared daemon gets {"project_key": ..., "cmd": [verb, args...]} """
+    if isinstance(msg, dict):
+        return msg["project_key"], msg["cmd"]
+    return "", msg
+
+
+def init(msg_id, key, options):
+    conn = CONNECTIONS.get(key)
+    if conn is None and not key and DEFAULT_CONNECT_ARGS is not None:
+        conn = connect("", *DEFAULT_CONNECT_ARGS)
+    elif conn is None:
+        # a shared daemon connects when asked to
+        port_file_path = options["port_file_path"]
+        project_type = options["project_type"]
+        project_path = options.get("project_path")
+        if not project_path:
+            project_path = get_project_path(port_file_path, project_type)
+        timeout_ms = options.get("timeout_ms", 4096)
+        conn = connect(key, port_file_path, project_type, project_path, timeout_ms)
+    # before anything is sent, so that setting up the sessions cannot hang
+    ReplEval.set_request_timeout(conn, options.get("request_timeout_s", 600))
+    if conn.root_session is None:
+        out = [";; connected to nREPL"]
+        get_existing_sessions(conn, out)
+        acquire_root_session(conn, out)
+        setup_repl(conn, out)
+        if options.get("session_lanes", 1):
+            acquire_lane_sessions(conn, out)
     else:
-        code = "(in-ns user)"
-        out += [code]
-        f(None, code)
+        # a persistent daemon that an editor attaches to again
+        out = [";; attached to running daemon"]
+        out += [";; current session: " + conn.root_session]
+    # every option is set again, an editor that attaches to a persistent
+    # daemon must not inherit those of the one before it
+    ReplEval.set_output_limit(conn, options.get("output_limit_bytes"))
+    interrupt_timeout = None
+    if options.get("interrupt_on_timeout"):
+        interrupt_timeout = conn.timeout_ms
+    ReplEval.set_interrupt_timeout(conn, interrupt_timeout)
+    flush_ms = None
+    if options.get("stream_output"):
+        flush_ms = options.get("stream_flush_ms", 100)
+    ReplEval.set_stream_flush_interval(conn, flush_ms)
+    conn.to_vim(msg_id, {"lines": out})
+
+
+def disconnect(conn):
+    # an init that comes right after has to connect again, only closing the
+    # socket is left to the writer
+    remove_connection(conn)
+    ReplEval.abandon_all(conn, "disconnected from nREPL")
+    for session_id in set(conn.sessions.values()):
+        conn.send({"op": "close", "session": session_id})
+    conn.disconnect()
 
 
 def process_command_from_vim(obj):
@@ -92,29 +193,39 @@ def process_command_from_vim(obj):
     LAST_COMMAND_SUCCESSFUL = True
 
     msg_id, msg = obj
+    key, msg = _unwrap(msg)
     verb = msg[0]
     args = msg[1:]
+    conn = CONNECTIONS.get(key)
 
     if verb == "init":
-        out = [";; connected to nREPL"]
-        get_existing_sessions(out)
-        acquire_root_session(out)
-        ReplEval.set_root_session(ROOT_SESSION)
-        plasmaplace_repl_eval.start_repl_read_dispatch_loop()
-        setup_repl(out)
-        to_vim(msg_id, {"lines": out})
-        start_keepalive_loop()
-    elif verb == "delete_other_nrepl_sessions":
-        for session_id in EXISTING_SESSIONS:
-            TO_NREPL.put({"op": "close", "session": session_id})
-        to_vim(msg_id, {"lines": []})
-    elif verb == "exit":
+        init(msg_id, key, args[0] if args else {})
+    elif verb == "shutdown":
+        SHUTDOWN.set()
         return False
+    elif verb == "exit":
+        if not key:
+            return False
+        # a project is done with the shared daemon
+        if conn is not None:
+            disconnect(conn)
+        to_vim(msg_id, {"lines": []}, key=key)
+    elif conn is None or conn.root_session is None:
+        # e.g. an init that failed, there is no session to send anything to
+        lines = [";; not connected to nREPL, try :Reconnect"]
+        to_vim(msg_id, {"lines": lines}, key=key)
+    elif verb == "delete_other_nrepl_sessions":
+        ours = set(conn.sessions.values())
+        for session_id in conn.existing_sessions:
+            if session_id in ours:
+                continue
+            conn.send({"op": "close", "session": session_id})
+        conn.to_vim(msg_id, {"lines": []})
     else:
         start_time = time.time()
 
         f = plasmaplace_commands.dispatcher[verb]
-        ret = f(*args)
+        ret = f(conn, *args)
         if isinstance(ret, dict):
             if (
                 LAST_COMMAND == "require"
@@ -124,7 +235,7 @@ def process_command_from_vim(obj):
             ):
                 ret["skip_center"] = True
             else:
-                ret["skip_center"] = False
+                ret.setdefault("skip_center", False)
 
             LAST_COMMAND_SUCCESSFUL = not ret["ex_happened"]
         else:
@@ -133,39 +244,207 @@ def process_command_from_vim(obj):
 
         end_time = time.time()
         duration = end_time - start_time
+        STATS.record("command." + verb, duration)
         duration = int(duration * 1000)
         do_async = False
-        if duration > TIMEOUT_MS:
+        if duration > conn.timeout_ms:
             do_async = True
-        to_vim(msg_id, ret, do_async)
+        conn.to_vim(msg_id, ret, do_async)
     return True
 
 
-################################################################################
+def run_command_from_vim(obj):
+    try:
+        return process_command_from_vim(obj)
+    except TooBusy:
+        STATS.incr("commands_busy")
+        key, _ = _unwrap(obj[1])
+        to_vim(obj[0], {"lines": BUSY_LINES, "ex_happened": True}, key=key)
+        return True
+    except:  # noqa
+        _debug(traceback.format_exc())
+        msg_id = obj[0]
+        key, _ = _unwrap(obj[1])
+        lines = [";; plasmaplace daemon error:"]
+        lines += traceback.format_exc().rstrip().split("\n")
+        to_vim(msg_id, {"lines": lines}, key=key)
+        return True
 
 
-def main(port_file_path, project_type, timeout_ms):
-    global PROJECT_PATH
-    if project_type == "shadow-cljs":
-        p = os.path.dirname(port_file_path)
-        p = os.path.join(p, "..")
-        p = os.path.normpath(p)
-        _debug(p)
-        PROJECT_PATH = p
-    else:
-        PROJECT_PATH = os.getcwd()
-    init(port_file_path, project_type, timeout_ms)
+def _order_key(obj):
+    key, msg = _unwrap(obj[1])
+    lane = ORDERED_VERBS.get(msg[0])
+    return None if lane is None else (key, lane)
 
-    for line in sys.stdin:
-        obj = json.loads(line)
+
+def _next_in_order(order_key):
+    """ The command that was waiting for the one that just ran, if any """
+    with ORDERED_LOCK:
+        pending = ORDERED_PENDING[order_key]
+        if pending:
+            return pending.popleft()
+        del ORDERED_PENDING[order_key]
+        return None
+
+
+def _command_worker_loop():
+    while True:
+        obj = COMMANDS.get(block=True)
+        order_key = _order_key(obj)
+        while obj is not None:
+            run_command_from_vim(obj)
+            obj = None if order_key is None else _next_in_order(order_key)
+
+
+def queue_command(obj):
+    """ Hands obj to the workers, unless too many commands are waiting """
+    key, msg = _unwrap(obj[1])
+    with ORDERED_LOCK:
+        queued = COMMANDS.qsize() + sum(len(x) for x in ORDERED_PENDING.values())
+        STATS.gauge("commands_queued", queued)
+        if queued >= MAX_QUEUED_COMMANDS:
+            STATS.incr("commands_busy")
+            to_vim(obj[0], {"lines": BUSY_LINES, "ex_happened": True}, key=key)
+            return
+        if (
+            msg[0] == "reload"
+            and key in CONNECTIONS
+            and plasmaplace_commands.queue_reload(key, msg[1])
+        ):
+            # joins the reload that has not run yet
+            reply = {"lines": [], "skip_center": True, "ex_happened": False}
+            to_vim(obj[0], reply, key=key)
+            return
+        order_key = _order_key(obj)
+        if order_key is not None:
+            pending = ORDERED_PENDING.get(order_key)
+            if pending is not None:
+                pending.append(obj)
+                return
+            ORDERED_PENDING[order_key] = deque()
+    COMMANDS.put(obj)
+
+
+def start_command_workers():
+    for _ in range(MAX_WORKERS):
+        t1 = threading.Thread(target=_command_worker_loop, daemon=True)
+        t1.daemon = True
+        t1.start()
+
+
+################################################################################
+
+
+def run_commands_from_vim(lines):
+    """ Returns once Vim has gone or asked to exit. """
+    for line in lines:
+        with STATS.timer("vim_json_decode"):
+            obj = json.loads(line)
         _debug(obj)
-        should_continue = process_command_from_vim(obj)
+        verb = _unwrap(obj[1])[1][0]
+        if verb not in SERIAL_VERBS:
+            queue_command(obj)
+            continue
+        should_continue = run_command_from_vim(obj)
         if not should_continue:
-            break
+            return
 
-    TO_NREPL.put({"op": "close", "session": ROOT_SESSION})
-    TO_NREPL.put("exit")
-    EXIT_SIGNAL_QUEUE.get(block=True)
+
+def _serve_client(sock):
+    out = sock.makefile("w", encoding="utf-8")
+    set_vim_output(out)
+    try:
+        run_commands_from_vim(sock.makefile("r", encoding="utf-8"))
+    except (OSError, ValueError):
+        pass
+    finally:
+        set_vim_output(None, out)
+        sock.close()
+
+
+def _listen(socket_path):
+    # another daemon may have won the race to start
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+        return None
+    except OSError:
+        pass
+    finally:
+        probe.close()
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(4)
+    listener.settimeout(1.0)
+    return listener
+
+
+def serve(socket_path, idle_timeout):
+    """
+    Lets editors attach over a Unix domain socket, one at a time, a new one
+    takes over from the last. Exits after idle_timeout seconds without one.
+    """
+    listener = _listen(socket_path)
+    if listener is None:
+        return
+    client = None
+    idle_since = time.time()
+    try:
+        while not SHUTDOWN.is_set():
+            if client is not None and not client.is_alive():
+                client = None
+                idle_since = time.time()
+            try:
+                sock, _ = listener.accept()
+            except socket.timeout:
+                if client is None and time.time() - idle_since > idle_timeout:
+                    break
+                continue
+            sock.settimeout(None)
+            client = threading.Thread(target=_serve_client, args=(sock,), daemon=True)
+            client.start()
+    finally:
+        listener.close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+def main(argv):
+    """
+    plasmaplace.py PORT_FILE PROJECT_TYPE TIMEOUT_MS serves one project,
+    plasmaplace.py --shared serves every project that sends it "init", and
+    plasmaplace.py --listen SOCKET ... serves one project to whichever editor
+    attaches to it.
+    """
+    global DEFAULT_CONNECT_ARGS
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shared", action="store_true")
+    parser.add_argument("--listen")
+    parser.add_argument("--idle-timeout", type=float, default=1800)
+    parser.add_argument("args", nargs="*")
+    options = parser.parse_args(argv)
+
+    start_io_loops()
+    plasmaplace_repl_eval.start_repl_read_dispatch_loop(connection_lost)
+    if not options.shared:
+        port_file_path, project_type, timeout_ms = options.args[:3]
+        project_path = get_project_path(port_file_path, project_type)
+        DEFAULT_CONNECT_ARGS = (port_file_path, project_type, project_path, timeout_ms)
+        connect("", *DEFAULT_CONNECT_ARGS)
+    start_command_workers()
+    start_keepalive_loop()
+
+    if options.listen:
+        set_vim_output(None)
+        serve(options.listen, options.idle_timeout)
+    else:
+        run_commands_from_vim(sys.stdin)
+
+    for conn in list(CONNECTIONS.values()):
+        disconnect(conn)
+    TO_NREPL.put((None, "exit"))
     EXIT_SIGNAL_QUEUE.get(block=True)
     sys.exit(0)
 
@@ -173,4 +452,4 @@ def main(port_file_path, project_type, timeout_ms):
 if __name__ == "__main__":
     _debug("started")
     _debug(sys.argv)
-    main(sys.argv[1], sys.argv[2], sys.argv[3])
+    main(sys.argv[1:])
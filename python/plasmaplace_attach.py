@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+__doc__ = """
+A thin stand-in for the daemon that Vim starts instead of plasmaplace.py when
+the daemon should outlive the editor. It attaches to the project's persistent
+daemon over a Unix domain socket, starting one first if there is none, and
+then only relays lines between Vim and the daemon.
+
+    plasmaplace_attach.py PORT_FILE PROJECT_TYPE TIMEOUT_MS IDLE_TIMEOUT_S
+"""
+
+import os
+import sys
+import time
+import socket
+import threading
+import subprocess
+
+from plasmaplace_utils import get_project_path, get_daemon_socket_path
+
+PYTHON_DIR = os.path.dirname(os.path.abspath(__file__))
+DAEMON_PATH = os.path.join(PYTHON_DIR, "plasmaplace.py")
+START_TIMEOUT = 10.0
+
+
+def _connect(socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def _start_daemon(socket_path, args):
+    cmd = [sys.executable, DAEMON_PATH, "--listen", socket_path]
+    cmd += ["--idle-timeout", args[3], args[0], args[1], args[2]]
+    subprocess.Popen(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def attach(args):
+    port_file_path, project_type = args[0], args[1]
+    project_path = get_project_path(port_file_path, project_type)
+    socket_path = get_daemon_socket_path(project_path)
+    sock = _connect(socket_path)
+    if sock is None:
+        _start_daemon(socket_path, args)
+        deadline = time.time() + START_TIMEOUT
+        while sock is None and time.time() < deadline:
+            time.sleep(0.02)
+            sock = _connect(socket_path)
+    if sock is None:
+        sys.stderr.write("plasmaplace: could not attach to " + socket_path + "\n")
+        sys.exit(1)
+    return sock
+
+
+def _relay_to_vim(sock):
+    out = sys.stdout.buffer
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            break
+        out.write(data)
+        out.flush()
+    # the daemon went away, so does the editor's view of it
+    os._exit(0)
+
+
+def main(args):
+    sock = attach(args)
+    t1 = threading.Thread(target=_relay_to_vim, args=(sock,), daemon=True)
+    t1.start()
+    stdin = sys.stdin.buffer
+    while True:
+        data = stdin.readline()
+        if not data:
+            break
+        sock.sendall(data)
+    # detach, the daemon keeps running
+    sock.shutdown(socket.SHUT_WR)
+    t1.join(1.0)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -2,91 +2,692 @@ import sys
 import uuid
 import time
 import ast
-from queue import Queue
-from plasmaplace_io import TO_NREPL, read_nrepl_msg, _debug
-from plasmaplace_repl_eval import ReplEval
+import threading
+from queue import Queue, Empty
+from plasmaplace_io import _debug
+from plasmaplace_repl_eval import ReplEval, SpilledOutput, SEPARATOR
+from plasmaplace_utils import unquote_symbol, pr_str, LRUCache, PrefixIndex
+from plasmaplace_reader import top_level_forms
+from plasmaplace_index import get_index, parse_ns, NS_FORM_RE
+from plasmaplace_stats import STATS
+import plasmaplace_history
 
+# (project key, ns, symbol) -> (namespace the symbol resolved to, popup lines)
+DOC_CACHE = LRUCache(512)
 
-def switch_to_ns(ns):
-    code = "(in-ns %s)" % ns
-    ret = ReplEval(code)
-    return ret
+
+def invalidate_docs(conn, namespaces):
+    namespaces = set(namespaces)
+    DOC_CACHE.remove_if(
+        lambda k, v: k[0] == conn.key and (k[1] in namespaces or v[0] in namespaces)
+    )
+
+
+def clear_docs(conn):
+    DOC_CACHE.remove_if(lambda k, v: k[0] == conn.key)
+
+
+# (project key, ns) -> (aliased namespaces, PrefixIndex of what can be typed
+# in ns)
+COMPLETIONS = LRUCache(64)
+
+
+def invalidate_completions(conn, namespaces):
+    namespaces = set(namespaces)
+    COMPLETIONS.remove_if(
+        lambda k, v: k[0] == conn.key and (k[1] in namespaces or v[0] & namespaces)
+    )
+
+
+def clear_completions(conn):
+    COMPLETIONS.remove_if(lambda k, v: k[0] == conn.key)
+
+
+def namespaces_changed(conn, namespaces):
+    """ Drops everything cached about namespaces """
+    invalidate_docs(conn, namespaces)
+    invalidate_completions(conn, namespaces)
 
 
-def doc(ns, symbol):
-    ret = switch_to_ns(ns)
-    if not ret.success:
-        return ret.to_popup()
+ReplEval.add_changed_namespaces_listener(namespaces_changed)
+
+
+def _resolved_ns(lines):
+    # (doc) prints a line of dashes followed by the qualified name
+    for line in lines:
+        if line and not line.startswith("-"):
+            if "/" in line:
+                return line.split("/", 1)[0]
+            return None
+    return None
+
+
+def doc(conn, ns, symbol):
+    ns = unquote_symbol(ns)
+    cached = DOC_CACHE.get((conn.key, ns, symbol))
+    if cached is not None:
+        STATS.incr("doc_cache_hits")
+        return {"popup": cached[1], "ex_happened": False}
+    STATS.incr("doc_cache_misses")
 
     code = "(with-out-str (clojure.repl/doc %s))" % (symbol,)
-    ret = ReplEval(code, eval_value=True)
-    return ret.to_popup()
+    ret = ReplEval(conn, code, eval_value=True, ns=ns, lane="tooling")
+    popup = ret.to_popup()
+    if ret.success and ret.raw_value:
+        lines = popup["popup"]
+        DOC_CACHE.put((conn.key, ns, symbol), (_resolved_ns(lines), lines))
+    return popup
 
 
-def _eval(ns, code):
+def _eval(conn, ns, code):
+    start = time.time()
+    ret = ReplEval(
+        conn,
+        code,
+        echo_code=True,
+        stream=True,
+        interruptible=True,
+        ns=unquote_symbol(ns),
+    )
+    reply = ret.to_scratch_buf()
     if ns is not None:
-        ret = switch_to_ns(ns)
-        if not ret.success:
-            return ret.to_scratch_buf()
+        # a (def) may have changed what (doc) has to say
+        namespaces_changed(conn, [unquote_symbol(ns)])
+        duration = time.time() - start
+        plasmaplace_history.record(conn, unquote_symbol(ns), code, duration, ret)
+    return reply
+
 
-    ret = ReplEval(code, echo_code=True)
+def run_tests(conn, ns, code):
+    ret = ReplEval(
+        conn,
+        code,
+        echo_code=True,
+        eval_value=True,
+        interruptible=True,
+        ns=unquote_symbol(ns),
+        lane="tests",
+    )
     return ret.to_scratch_buf()
 
 
-def run_tests(ns, code):
-    if ns is not None:
-        ret = switch_to_ns(ns)
-        if not ret.success:
-            return ret.to_scratch_buf()
+TEST_COUNTS_MARKER = ";;__plasmaplace_test_counts__"
+TEST_NS_TEMPLATE = """(let [w (java.io.StringWriter.)
+      r (binding [*out* w clojure.test/*test-out* w]
+          (clojure.test/test-ns '%s))]
+  (str w "\\n%s " (:test r 0) " " (:pass r 0) " " (:fail r 0) " " (:error r 0)))"""
+FIND_TEST_NSES_TEMPLATE = """(->> (all-ns)
+     (filter (fn [n] (some (comp :test meta) (vals (ns-interns n)))))
+     (map (comp str ns-name))
+     (filter #(re-matches (re-pattern %s) %%))
+     (sort)
+     (clojure.string/join " "))"""
 
-    ret = ReplEval(code, echo_code=True, eval_value=True)
-    return ret.to_scratch_buf()
 
+def _find_test_nses(conn, pattern):
+    code = FIND_TEST_NSES_TEMPLATE % (pr_str(pattern or ".*"),)
+    ret = ReplEval(conn, code, eval_value=True, silent=True, lane="tests")
+    if not ret.success or not ret.raw_value:
+        return []
+    return ret.raw_value.split(" ")
 
-def macroexpand(ns, code):
-    if ns:
-        ret = switch_to_ns(ns)
-        if not ret.success:
-            return ret.to_scratch_buf()
 
+def _test_ns(conn, lane, ns):
+    """ Returns ([tests, pass, fail, error], output lines, seconds) """
+    start = time.time()
+    code = TEST_NS_TEMPLATE % (ns, TEST_COUNTS_MARKER)
+    ret = ReplEval(
+        conn, code, eval_value=True, silent=True, interruptible=True, lane=lane
+    )
+    duration = time.time() - start
+    value = ret.raw_value if isinstance(ret.raw_value, str) else ""
+    out, _, counts = value.rpartition("\n" + TEST_COUNTS_MARKER + " ")
+    if not ret.success or not counts:
+        # e.g. the namespace does not exist, count it as an error
+        return [0, 0, 0, 1], ret.extract_output(), duration
+    return [int(x) for x in counts.split()], out.split("\n"), duration
+
+
+def _error_lines(e):
+    return [";; %s: %s" % (type(e).__name__, e)]
+
+
+def _report_ns(conn, ns, counts, lines, duration, results, stream_id):
+    results.append(counts)
+    tests, passed, failed, errors = counts
+    summary = ";; %s: %d tests, %d assertions, %d failures, %d errors (%.2fs)" % (
+        ns,
+        tests,
+        passed + failed + errors,
+        failed,
+        errors,
+        duration,
+    )
+    msg_lines = [summary]
+    if failed or errors:
+        msg_lines += lines
+    conn.to_vim(0, {"lines": msg_lines, "stream": stream_id, "skip_center": True})
+
+
+def _test_worker(conn, lane, todo, results, stream_id, clone_errors):
+    try:
+        ReplEval.clone_session(conn, lane)
+    except Exception as e:
+        # the other lanes take over, or what is left counts as errors
+        clone_errors.append(e)
+        return
+    while True:
+        try:
+            ns = todo.get_nowait()
+        except Empty:
+            return
+        start = time.time()
+        try:
+            counts, lines, duration = _test_ns(conn, lane, ns)
+        except Exception as e:
+            # e.g. TooBusy, counted like a namespace that fails to load
+            counts, lines = [0, 0, 0, 1], _error_lines(e)
+            duration = time.time() - start
+        _report_ns(conn, ns, counts, lines, duration, results, stream_id)
+
+
+def run_tests_parallel(conn, nses, pattern="", num_sessions=4):
+    """
+    Runs clojure.test namespaces concurrently on several sessions, reporting
+    each namespace as it finishes and the combined counts at the end. With no
+    nses every loaded namespace with tests that matches pattern is run.
+    """
+    start = time.time()
+    if not nses:
+        nses = _find_test_nses(conn, pattern)
+    if not nses:
+        return {"lines": [SEPARATOR, ";; no tests found"], "ex_happened": False}
+
+    num_sessions = max(1, min(int(num_sessions), len(nses)))
+    lanes = ["tests.%d" % (i,) for i in range(num_sessions)]
+
+    stream_id = str(uuid.uuid4())
+    header = ";; running %d namespace(s) on %d session(s)" % (len(nses), len(lanes))
+    conn.to_vim(0, {"lines": [SEPARATOR, header], "stream": stream_id})
+
+    todo = Queue()
+    for ns in nses:
+        todo.put(ns)
+    results = []
+    clone_errors = []
+    threads = []
+    for lane in lanes:
+        args = (conn, lane, todo, results, stream_id, clone_errors)
+        t = threading.Thread(target=_test_worker, args=args, daemon=True)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    while not todo.empty():
+        # no session could be cloned to run these on
+        lines = _error_lines(clone_errors[0])
+        _report_ns(conn, todo.get(), [0, 0, 0, 1], lines, 0.0, results, stream_id)
+
+    tests, passed, failed, errors = [sum(x) for x in zip([0, 0, 0, 0], *results)]
+    lines = [
+        ";; Ran %d tests containing %d assertions in %d namespace(s), %.2fs."
+        % (tests, passed + failed + errors, len(results), time.time() - start),
+        ";; %d failures, %d errors." % (failed, errors),
+    ]
+    return {"lines": lines, "ex_happened": bool(failed or errors)}
+
+
+def macroexpand(conn, ns, code):
     code = "(macroexpand (quote\n%s))" % (code,)
-    ret = ReplEval(code, eval_value=False, echo_code=True)
+    ret = ReplEval(
+        conn,
+        code,
+        eval_value=False,
+        echo_code=True,
+        ns=unquote_symbol(ns),
+        lane="tooling",
+    )
     return ret.to_scratch_buf()
 
 
-def macroexpand1(ns, code):
-    ret = switch_to_ns(ns)
-    if not ret.success:
-        return ret.to_scratch_buf()
-
+def macroexpand1(conn, ns, code):
     code = "(macroexpand-1 (quote\n%s))" % (code,)
-    ret = ReplEval(code, eval_value=False, echo_code=True)
+    ret = ReplEval(
+        conn,
+        code,
+        eval_value=False,
+        echo_code=True,
+        ns=unquote_symbol(ns),
+        lane="tooling",
+    )
     return ret.to_scratch_buf()
 
 
-def require(ns, reload_level):
+def require(conn, ns, reload_level):
+    if reload_level == ":reload-all":
+        clear_docs(conn)
+        clear_completions(conn)
+    else:
+        namespaces_changed(conn, [unquote_symbol(ns)])
     code = "(clojure.core/require %s %s)" % (ns, reload_level)
-    ret = ReplEval(code, eval_value=False, echo_code=True, silent=True)
+    ret = ReplEval(conn, code, eval_value=False, echo_code=True, silent=True)
     return ret.to_scratch_buf()
 
 
-def cljfmt(code):
+# project key -> files saved since the pending reload started waiting
+RELOAD_PENDING = {}
+RELOAD_LOCK = threading.Lock()
+# namespaces that are not loaded yet are left alone, except the saved ones
+RELOAD_TEMPLATE = """(let [saved '#{%s}
+      nses (filterv #(or (saved %%) (find-ns %%)) '[%s])]
+  (apply clojure.core/require (conj nses :reload))
+  nses)"""
+
+
+def queue_reload(key, path):
+    """
+    Adds path to the reload of project key that has not run yet, returns
+    False when there was none and a reload command has to run for it
+    """
+    with RELOAD_LOCK:
+        pending = RELOAD_PENDING.get(key)
+        if pending is None:
+            RELOAD_PENDING[key] = {path}
+            return False
+        pending.add(path)
+        return True
+
+
+def reload(conn, path, debounce_ms=200):
+    """
+    Reloads the namespace of a saved file and every loaded namespace that
+    depends on it, dependencies first. Saves that come within debounce_ms of
+    each other are reloaded together.
+    """
+    with RELOAD_LOCK:
+        # already there when it was queued with queue_reload()
+        RELOAD_PENDING.setdefault(conn.key, set()).add(path)
+    time.sleep(debounce_ms / 1000.0)
+    with RELOAD_LOCK:
+        paths = RELOAD_PENDING.pop(conn.key)
+
+    index = get_index(conn.project_path)
+    index.refresh()
+    saved = {index.ns_of(p) for p in paths} - {None}
+    if not saved:
+        return {"lines": [], "skip_center": True, "ex_happened": False}
+    order = index.reload_order(saved)
+    namespaces_changed(conn, order)
+    code = RELOAD_TEMPLATE % (" ".join(sorted(saved)), " ".join(order))
+    ret = ReplEval(conn, code)
+    reply = ret.to_scratch_buf()
+    reply["lines"].insert(1, ";; reloading " + " ".join(order))
+    return reply
+
+
+# (project key, path) -> (ns form, text of every other top-level form) as of
+# the last time the file was loaded
+LOADED_FORMS = LRUCache(256)
+
+
+def _require_file(conn, path, ns, forms):
+    code = "(clojure.core/require '%s :reload)" % (ns,)
+    ret = ReplEval(conn, code, echo_code=True, silent=True)
+    if ret.success:
+        LOADED_FORMS.put((conn.key, path), forms)
+    return ret.to_scratch_buf()
+
+
+def reload_changed(conn, path):
+    """
+    Evaluates only the top-level forms of a file that changed since it was
+    last loaded, falls back to requiring it when its ns form changed
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        forms = top_level_forms(text)
+    except (OSError, ValueError) as e:
+        lines = [SEPARATOR, ";; could not read %s: %s" % (path, e)]
+        return {"lines": lines, "ex_happened": True}
+    ns_form = next((x.text for x in forms if NS_FORM_RE.match(x.text)), None)
+    ns, _ = parse_ns(ns_form or "")
+    if ns is None:
+        lines = [SEPARATOR, ";; no ns form in " + path]
+        return {"lines": lines, "ex_happened": True}
+    namespaces_changed(conn, [ns])
+
+    others = [x for x in forms if x.text != ns_form]
+    snapshot = (ns_form, {x.text for x in others})
+    loaded = LOADED_FORMS.get((conn.key, path))
+    if loaded is None or loaded[0] != ns_form:
+        return _require_file(conn, path, ns, snapshot)
+
+    changed = [x for x in others if x.text not in loaded[1]]
+    lines = [SEPARATOR, ";; %s: %d changed form(s)" % (ns, len(changed))]
+    ex_happened = False
+    for form in changed:
+        column = form.start - _line_offset(text, form.start) + 1
+        position = (path, form.start_line + 1, column)
+        ret = ReplEval(conn, form.text, silent=True, ns=ns, position=position)
+        lines += [form.text.split("\n", 1)[0]]
+        lines += ret.extract_output()
+        if not ret.success:
+            ex_happened = True
+            break
+    if not ex_happened:
+        LOADED_FORMS.put((conn.key, path), snapshot)
+    return {"lines": lines, "ex_happened": ex_happened}
+
+
+# sessions that already have cljfmt.core loaded
+CLJFMT_SESSIONS = set()
+# buffer key -> text of every top-level form as of the last format
+CLJFMT_FORMATTED = LRUCache(64)
+CLJFMT_FORM_SEPARATOR = "\n;;__plasmaplace_cljfmt_form__\n"
+
+
+def _require_cljfmt(conn):
+    session = conn.sessions.get("tooling") or conn.root_session
+    if session in CLJFMT_SESSIONS:
+        return True
     require_cljfmt_code = "(require 'cljfmt.core)"
-    ret = ReplEval(require_cljfmt_code, eval_value=False, echo_code=True, silent=True)
-    # if not ret.success:
-    #     return ret.to_scratch_buf()
+    ret = ReplEval(
+        conn,
+        require_cljfmt_code,
+        eval_value=False,
+        echo_code=True,
+        silent=True,
+        lane="tooling",
+    )
+    if ret.success:
+        CLJFMT_SESSIONS.add(session)
+    return ret.success
+
+
+def cljfmt(conn, code):
+    _require_cljfmt(conn)
 
     template = "(with-out-str (print (cljfmt.core/reformat-string %s nil)))"
     code = template % (code,)
-    ret = ReplEval(code, eval_value=True, echo_code=False, silent=True)
+    ret = ReplEval(
+        conn, code, eval_value=True, echo_code=False, silent=True, lane="tooling"
+    )
     return ret.to_value()
 
 
+def _reformat_forms(conn, texts):
+    template = (
+        "(with-out-str (print (clojure.string/join %s "
+        "(map #(cljfmt.core/reformat-string %% nil) [%s]))))"
+    )
+    code = template % (pr_str(CLJFMT_FORM_SEPARATOR), " ".join(map(pr_str, texts)))
+    ret = ReplEval(
+        conn, code, eval_value=True, echo_code=False, silent=True, lane="tooling"
+    )
+    if not ret.success or not isinstance(ret.raw_value, str):
+        return None
+    formatted = ret.raw_value.split(CLJFMT_FORM_SEPARATOR)
+    if len(formatted) != len(texts):
+        return None
+    return formatted
+
+
+def cljfmt_incremental(conn, key, text):
+    """
+    Only sends the top-level forms that changed since the last format of this
+    buffer to cljfmt. Returns [start, end, lines] patches, 0-based and end
+    exclusive, sorted by start line.
+    """
+    try:
+        forms = top_level_forms(text)
+    except ValueError:
+        return {"value": None, "ex_happened": False}
+
+    known = CLJFMT_FORMATTED.get(key, set())
+    changed = []
+    for form in forms:
+        if form.text in known:
+            continue
+        prefix = text[_line_offset(text, form.start):form.start]
+        if prefix.strip():
+            # shares its first line with another form, leave it alone
+            continue
+        changed.append(form)
+
+    formatted = []
+    if changed:
+        if not _require_cljfmt(conn):
+            return {"value": None, "ex_happened": True}
+        formatted = _reformat_forms(conn, [form.text for form in changed])
+        if formatted is None:
+            return {"value": None, "ex_happened": True}
+
+    # only what cljfmt has seen, skipped forms are not known to be formatted
+    result = {form.text for form in forms if form.text in known}
+    patches = []
+    last_line = -1
+    for form, new_text in zip(changed, formatted):
+        if form.start_line <= last_line:
+            # overlaps the previous patch, it gets formatted next time
+            continue
+        result.add(new_text)
+        last_line = form.end_line
+        if new_text == form.text:
+            continue
+        suffix_end = text.find("\n", form.end)
+        if suffix_end < 0:
+            suffix_end = len(text)
+        suffix = text[form.end:suffix_end]
+        new_lines = (new_text + suffix).split("\n")
+        patches.append([form.start_line, form.end_line + 1, new_lines])
+    CLJFMT_FORMATTED.put(key, result)
+    return {"value": patches, "ex_happened": False}
+
+
+def _line_offset(text, pos):
+    """ offset of the beginning of the line pos is on """
+    return text.rfind("\n", 0, pos) + 1
+
+
+def interrupt(conn):
+    n = ReplEval.interrupt_all(conn)
+    lines = [";; interrupting %d evaluation(s)" % (n,)]
+    return {"lines": lines, "ex_happened": False}
+
+
+# prints every cause of *e with runs of JVM and Clojure frames collapsed
+PROJECT_STACKTRACE_CODE = r"""(do
+  (require 'clojure.repl)
+  (let [internal? (fn [^StackTraceElement f]
+                    (re-find #"^(clojure\.|java\.|javax\.|jdk\.|sun\.|nrepl\.)"
+                             (.getClassName f)))
+        fmt (fn [^StackTraceElement f]
+              (let [c (.getClassName f)]
+                (str (if (.contains c "$")
+                       (clojure.repl/demunge c)
+                       (str c "." (.getMethodName f)))
+                     " (" (.getFileName f) ":" (.getLineNumber f) ")")))]
+    (with-out-str
+      (doseq [^Throwable e (take-while some? (iterate #(.getCause ^Throwable %) *e))]
+        (println (str (.getName (class e)) ": " (.getMessage e)))
+        (doseq [frames (partition-by (comp boolean internal?) (.getStackTrace e))]
+          (if (internal? (first frames))
+            (println (str "  ... " (count frames) " internal frame(s)"))
+            (doseq [f frames]
+              (println (str "  " (fmt f))))))))))"""
+
+
+def stacktrace(conn, project_only=False):
+    """ The stack trace of the last exception, fetched only when asked for """
+    lane = conn.last_ex_lane
+    if lane is None:
+        return {"lines": [SEPARATOR, ";; no exception to show"], "ex_happened": False}
+    if project_only and conn.project_type != "shadow-cljs":
+        code = PROJECT_STACKTRACE_CODE
+        ret = ReplEval(conn, code, eval_value=True, lane=lane)
+    else:
+        ret = ReplEval(conn, "*e", lane=lane)
+    return ret.to_scratch_buf()
+
+
+# one line per symbol, alias qualified var and namespace, as
+# word TAB kind TAB info, then one that lists the aliased namespaces
+COMPLETIONS_TEMPLATE = r"""(let [ns (or (find-ns '%s) *ns*)
+      kind (fn [v] (cond (class? v) "c"
+                         (not (var? v)) "v"
+                         (:macro (meta v)) "m"
+                         (:arglists (meta v)) "f"
+                         :else "v"))
+      info (fn [v] (clojure.string/replace
+                     (cond (class? v) (.getName ^Class v)
+                           (var? v) (str (or (:arglists (meta v)) ""))
+                           :else "")
+                     #"\s+" " "))
+      row (fn [s v] (str s "\t" (kind v) "\t" (info v)))]
+  (clojure.string/join "\n"
+    (concat
+      (for [[s v] (ns-map ns)] (row s v))
+      (for [[a n] (ns-aliases ns) [s v] (ns-publics n)] (row (str a "/" s) v))
+      (for [n (all-ns)] (str (ns-name n) "\tn\t"))
+      [(str "\t\t" (clojure.string/join
+                       " " (map ns-name (vals (ns-aliases ns)))))])))"""
+MAX_COMPLETIONS = 500
+
+
+def _build_completions(conn, ns):
+    code = COMPLETIONS_TEMPLATE % (ns,)
+    ret = ReplEval(conn, code, eval_value=True, silent=True, lane="tooling")
+    if not ret.success or not isinstance(ret.raw_value, str):
+        return None
+    items = []
+    aliased = set()
+    for line in ret.raw_value.split("\n"):
+        word, kind, info = (line.split("\t", 2) + ["", ""])[:3]
+        if word:
+            items.append((word, (kind, info)))
+        elif not kind:
+            # the last line names the namespaces that aliases point to
+            aliased = set(info.split())
+    entry = (aliased, PrefixIndex(items))
+    COMPLETIONS.put((conn.key, ns), entry)
+    return entry
+
+
+def _nrepl_completions(conn, ns, prefix):
+    """ For REPLs the eval above does not work in, e.g. ClojureScript """
+    session = conn.sessions.get("tooling") or conn.root_session
+    payload = {"op": "completions", "prefix": prefix, "session": session}
+    if ns:
+        payload["ns"] = ns
+    msg = ReplEval.request(conn, payload)
+    ret = []
+    for x in msg.get("completions", [])[:MAX_COMPLETIONS]:
+        kind = x.get("type", "")[:1]
+        ret.append({"word": x["candidate"], "kind": kind, "menu": x.get("ns", "")})
+    return ret
+
+
+def complete(conn, ns, prefix):
+    """
+    Completion candidates for prefix in ns. What can be typed in a namespace
+    is fetched once and then answered from memory until the namespace, or one
+    it aliases, changes.
+    """
+    ns = unquote_symbol(ns)
+    if conn.project_type == "shadow-cljs":
+        return {"value": _nrepl_completions(conn, ns, prefix), "ex_happened": False}
+    entry = COMPLETIONS.get((conn.key, ns))
+    if entry is None:
+        STATS.incr("completion_cache_misses")
+        entry = _build_completions(conn, ns)
+        if entry is None:
+            return {"value": [], "ex_happened": True}
+    else:
+        STATS.incr("completion_cache_hits")
+    with STATS.timer("completion_search"):
+        matches = entry[1].search(prefix, MAX_COMPLETIONS)
+    ret = [{"word": w, "kind": k, "menu": info} for w, (k, info) in matches]
+    return {"value": ret, "ex_happened": False}
+
+
+def buffer_info(conn, path):
+    """ The namespace of a file and what it requires, from the project index """
+    info = get_index(conn.project_path).buffer_info(path)
+    return {"value": info, "ex_happened": False}
+
+
+def more(conn, handle=""):
+    """ The next page of output that was too large to send to Vim at once """
+    if not handle:
+        handle = SpilledOutput.last_handle
+    spilled = SpilledOutput.instances.get(handle) if handle else None
+    if spilled is None:
+        lines = [";; no omitted output to show"]
+    else:
+        lines = spilled.next_page()
+    return {"lines": [SEPARATOR] + lines, "ex_happened": False}
+
+
+def history(conn, query="", limit=20):
+    """ The last evaluations whose code contains query, oldest first """
+    found = plasmaplace_history.search(conn, query, int(limit))
+    if not found:
+        return {"lines": [SEPARATOR, ";; no history found"], "ex_happened": False}
+    lines = [SEPARATOR, ";; :PlasmaplaceRecall {id} shows an entry in full"]
+    for offset, entry in found:
+        when = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["t"]))
+        first_line = entry["code"].strip().split("\n", 1)[0]
+        ex = " EX" if entry["ex"] else ""
+        line = ";; [%d] %s %s %dms%s: %s" % (
+            offset,
+            when,
+            entry["ns"],
+            entry["ms"],
+            ex,
+            first_line,
+        )
+        lines.append(line)
+    return {"lines": lines, "ex_happened": False}
+
+
+def recall(conn, offset):
+    entry = plasmaplace_history.get(conn, int(offset))
+    if entry is None:
+        lines = [SEPARATOR, ";; no history entry %s" % (offset,)]
+        return {"lines": lines, "ex_happened": False}
+    when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["t"]))
+    header = ";; recalled from %s in %s, %dms" % (when, entry["ns"], entry["ms"])
+    lines = [SEPARATOR, header]
+    lines += entry["code"].split("\n")
+    lines += entry["out"]
+    return {"lines": lines, "ex_happened": False}
+
+
+def stats(conn, reset=False):
+    lines = [SEPARATOR] + STATS.report_lines()
+    if reset:
+        STATS.reset()
+    return {"lines": lines, "ex_happened": False}
+
+
 dispatcher = {}
 dispatcher["doc"] = doc
 dispatcher["eval"] = _eval
 dispatcher["run_tests"] = run_tests
+dispatcher["run_tests_parallel"] = run_tests_parallel
 dispatcher["macroexpand"] = macroexpand
 dispatcher["macroexpand1"] = macroexpand1
 dispatcher["require"] = require
+dispatcher["reload"] = reload
+dispatcher["reload_changed"] = reload_changed
 dispatcher["cljfmt"] = cljfmt
+dispatcher["cljfmt_incremental"] = cljfmt_incremental
+dispatcher["interrupt"] = interrupt
+dispatcher["stacktrace"] = stacktrace
+dispatcher["buffer_info"] = buffer_info
+dispatcher["complete"] = complete
+dispatcher["more"] = more
+dispatcher["history"] = history
+dispatcher["recall"] = recall
+dispatcher["stats"] = stats
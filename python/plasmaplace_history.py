@@ -0,0 +1,85 @@
+__doc__ = """
+An append-only file of every evaluation of a project, one JSON object per
+line. Entries are found by the offset of their line, so that neither a search
+nor a recall has to hold the whole file in memory.
+"""
+
+import os
+import json
+import time
+import threading
+from collections import deque
+from plasmaplace_utils import get_history_path
+
+# only the beginning of a long output is worth keeping
+MAX_OUTPUT_LINES = 200
+LOCK = threading.Lock()
+# path -> file kept open for appending
+FILES = {}
+
+
+def _append(path, data):
+    f = FILES.get(path)
+    if f is None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        f = FILES[path] = open(path, "a", encoding="utf-8")
+    f.write(data)
+    f.flush()
+
+
+def record(conn, ns, code, duration, ret):
+    """ Appends what the ReplEval ret did with code in ns """
+    entry = {
+        "t": int(time.time()),
+        "ns": ns,
+        "code": code,
+        "ms": int(duration * 1000),
+        "ex": ret.ex_happened,
+        "out": ret.output_lines()[:MAX_OUTPUT_LINES],
+    }
+    data = json.dumps(entry, separators=(",", ":")) + "\n"
+    path = get_history_path(conn.project_path)
+    with LOCK:
+        try:
+            _append(path, data)
+        except OSError:
+            FILES.pop(path, None)
+
+
+def search(conn, query, limit):
+    """ [(offset, entry)] of the last limit entries whose code has query """
+    path = get_history_path(conn.project_path)
+    found = deque(maxlen=limit)
+    try:
+        with open(path, "rb") as f:
+            needle = json.dumps(query)[1:-1].encode("utf-8")
+            offset = 0
+            for line in f:
+                if needle in line:
+                    found.append((offset, line))
+                offset += len(line)
+    except OSError:
+        return []
+    ret = []
+    for offset, line in found:
+        try:
+            entry = json.loads(line.decode("utf-8"))
+        except ValueError:
+            continue
+        if query in entry["code"]:
+            ret.append((offset, entry))
+    return ret
+
+
+def get(conn, offset):
+    """ The entry whose line starts at offset, None if there is none """
+    path = get_history_path(conn.project_path)
+    try:
+        with open(path, "rb") as f:
+            if offset > 0:
+                f.seek(offset - 1)
+                if f.read(1) != b"\n":
+                    return None
+            return json.loads(f.readline().decode("utf-8"))
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,283 @@
+__doc__ = """
+What the daemon knows about the source files of a project: which namespace
+each file declares, which namespaces it requires and the shadow-cljs builds.
+Files are only read again, and directories only listed again, when their
+mtime changes.
+"""
+
+import os
+import re
+import threading
+from plasmaplace_reader import (
+    top_level_forms,
+    read_data,
+    List,
+    Vector,
+    ReaderConditional,
+    Map,
+)
+
+SOURCE_EXTENSIONS = (".clj", ".cljc", ".cljs")
+SKIP_DIRS = {"target", "node_modules", "out"}
+# clauses of the ns form that name other namespaces of the project
+REQUIRE_CLAUSES = (":require", ":use", ":require-macros", ":use-macros")
+NS_FORM_RE = re.compile(r"^\(\s*ns[\s\n]")
+# the targets a REPL can be selected for
+SHADOW_REPL_TARGETS = (":browser", ":node-library", ":node-script")
+
+
+def _splice(items):
+    """ Reader conditionals contribute every branch """
+    for item in items:
+        if not isinstance(item, ReaderConditional):
+            yield item
+            continue
+        for value in item[1::2]:
+            if item.splicing and isinstance(value, (List, Vector)):
+                yield from _splice(value)
+            else:
+                yield value
+
+
+def _is_symbol(x):
+    return type(x) is str and not x.startswith(":")
+
+
+def _libspec_names(spec, prefix=""):
+    if isinstance(spec, List) and spec and spec[0] == "quote":
+        spec = spec[1]
+    if _is_symbol(spec):
+        return [prefix + spec]
+    if not isinstance(spec, (List, Vector)):
+        return []
+    items = list(_splice(spec))
+    if not items or not _is_symbol(items[0]):
+        # e.g. ["react" :as react]
+        return []
+    name = prefix + items[0]
+    rest = items[1:]
+    if not rest or (type(rest[0]) is str and rest[0].startswith(":")):
+        return [name]
+    # prefix list (foo.bar baz [qux :as q])
+    names = []
+    for x in rest:
+        names += _libspec_names(x, name + ".")
+    return names
+
+
+def parse_ns(text):
+    """ Returns (ns, required namespaces) or (None, []) without an ns form """
+    try:
+        forms = top_level_forms(text)
+    except ValueError:
+        return None, []
+    for form in forms:
+        if not NS_FORM_RE.match(form.text):
+            continue
+        try:
+            data, _ = read_data(form.text)
+        except ValueError:
+            return None, []
+        items = list(_splice(data))
+        if len(items) < 2 or not _is_symbol(items[1]):
+            return None, []
+        requires = []
+        for clause in items[2:]:
+            if not isinstance(clause, List) or not clause:
+                continue
+            if clause[0] not in REQUIRE_CLAUSES:
+                continue
+            for spec in _splice(clause[1:]):
+                if type(spec) is str and spec.startswith(":"):
+                    # :reload and friends
+                    continue
+                requires += _libspec_names(spec)
+        return items[1], requires
+    return None, []
+
+
+def _map_items(m):
+    return list(zip(m[0::2], m[1::2]))
+
+
+def parse_shadow_builds(text):
+    """ [(build id, target)] in the order shadow-cljs.edn lists them """
+    try:
+        config, _ = read_data(text)
+    except ValueError:
+        return []
+    if not isinstance(config, Map):
+        return []
+    builds = dict(_map_items(config)).get(":builds")
+    if not isinstance(builds, Map):
+        return []
+    ret = []
+    for build_id, build in _map_items(builds):
+        if isinstance(build, Map):
+            ret.append((build_id, dict(_map_items(build)).get(":target")))
+    return ret
+
+
+class ProjectIndex:
+    """
+    path -> (mtime, ns, requires) for every source file under the project,
+    refreshed by comparing mtimes
+    """
+
+    def __init__(self, project_path):
+        self.project_path = project_path
+        self.files = {}
+        # dir -> (mtime, subdirs, source files)
+        self.dirs = {}
+        self.shadow_builds = (None, [])
+        self.lock = threading.Lock()
+
+    def _list(self, path):
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return [], []
+        entry = self.dirs.get(path)
+        if entry is not None and entry[0] == mtime:
+            return entry[1], entry[2]
+        subdirs, files = [], []
+        try:
+            with os.scandir(path) as it:
+                for x in it:
+                    if x.is_dir(follow_symlinks=False):
+                        if not x.name.startswith(".") and x.name not in SKIP_DIRS:
+                            subdirs.append(x.path)
+                    elif x.name.endswith(SOURCE_EXTENSIONS):
+                        files.append(x.path)
+        except OSError:
+            pass
+        self.dirs[path] = (mtime, subdirs, files)
+        return subdirs, files
+
+    def _scan(self):
+        seen = set()
+        todo = [self.project_path]
+        while todo:
+            path = todo.pop()
+            seen.add(path)
+            subdirs, files = self._list(path)
+            todo += subdirs
+            yield from files
+        for path in list(self.dirs):
+            if path not in seen:
+                del self.dirs[path]
+
+    def _update(self, path):
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            self.files.pop(path, None)
+            return None
+        entry = self.files.get(path)
+        if entry is not None and entry[0] == mtime:
+            return entry
+        try:
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                ns, requires = parse_ns(f.read())
+        except OSError:
+            ns, requires = None, []
+        entry = (mtime, ns, requires)
+        self.files[path] = entry
+        return entry
+
+    def refresh(self):
+        with self.lock:
+            seen = set()
+            for path in self._scan():
+                seen.add(path)
+                self._update(path)
+            for path in list(self.files):
+                if path not in seen:
+                    del self.files[path]
+
+    def ns_of(self, path):
+        """ The namespace a file declares, read again if it changed """
+        with self.lock:
+            entry = self._update(os.path.abspath(path))
+        return entry[1] if entry else None
+
+    def buffer_info(self, path):
+        """ What Vim wants to know about a buffer, once """
+        with self.lock:
+            entry = self._update(os.path.abspath(path))
+        if entry is None:
+            return {"ns": None, "requires": []}
+        return {"ns": entry[1], "requires": entry[2]}
+
+    def get_shadow_builds(self):
+        path = os.path.join(self.project_path, "shadow-cljs.edn")
+        with self.lock:
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                return []
+            if self.shadow_builds[0] != mtime:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.shadow_builds = (mtime, parse_shadow_builds(f.read()))
+            return self.shadow_builds[1]
+
+    def shadow_primary_target(self):
+        """ The first build a REPL can be selected for, e.g. :app """
+        for build_id, target in self.get_shadow_builds():
+            if target in SHADOW_REPL_TARGETS:
+                return build_id
+        return None
+
+    def _graph(self, extensions):
+        """ ns -> namespaces it requires, only for files with extensions """
+        graph = {}
+        with self.lock:
+            for path, (_, ns, requires) in self.files.items():
+                if ns is not None and path.endswith(extensions):
+                    graph.setdefault(ns, set()).update(requires)
+        return graph
+
+    def reload_order(self, namespaces, extensions=(".clj", ".cljc")):
+        """
+        namespaces and every namespace of the project that depends on them,
+        directly or not, ordered so that a namespace comes after those it
+        requires
+        """
+        graph = self._graph(extensions)
+        dependents = {}
+        for ns, requires in graph.items():
+            for dep in requires:
+                dependents.setdefault(dep, set()).add(ns)
+        todo = list(namespaces)
+        affected = set(todo)
+        while todo:
+            for ns in dependents.get(todo.pop(), ()):
+                if ns not in affected:
+                    affected.add(ns)
+                    todo.append(ns)
+        # Kahn's algorithm on the affected part of the graph
+        pending = {ns: graph.get(ns, set()) & affected for ns in affected}
+        order = []
+        while pending:
+            ready = sorted(ns for ns, deps in pending.items() if not deps)
+            if not ready:
+                # a cycle, load the rest as it comes
+                ready = sorted(pending)
+            for ns in ready:
+                del pending[ns]
+            for deps in pending.values():
+                deps.difference_update(ready)
+            order += ready
+        return order
+
+
+INDEXES = {}
+INDEXES_LOCK = threading.Lock()
+
+
+def get_index(project_path):
+    with INDEXES_LOCK:
+        index = INDEXES.get(project_path)
+        if index is None:
+            index = INDEXES[project_path] = ProjectIndex(project_path)
+        return index
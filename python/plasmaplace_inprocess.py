@@ -0,0 +1,103 @@
+__doc__ = """
+Runs the daemon inside Vim's own python3 instead of as a subprocess. The
+threads are the same, but commands are handed over with a function call and
+replies are taken off TO_VIM_QUEUE by Vim, which turns the Python objects
+into Vim values with py3eval(), so neither side serializes them to JSON.
+
+Every project is served like a shared daemon serves it: commands are
+{"project_key": ..., "cmd": [...]} and "init" carries the port file.
+"""
+
+import json
+import time
+import itertools
+import threading
+from collections import deque
+from queue import Empty
+
+import plasmaplace
+import plasmaplace_repl_eval
+from plasmaplace_io import (
+    TO_VIM_QUEUE,
+    CONNECTIONS,
+    start_io_loops,
+    start_keepalive_loop,
+)
+
+STARTED = False
+START_LOCK = threading.Lock()
+# replies taken off the queue while waiting for another one, for poll()
+PENDING = deque()
+MSG_IDS = itertools.count(1)
+MAX_POLL_MSGS = 256
+STOP_TIMEOUT = 1.0
+
+
+def start():
+    global STARTED
+    with START_LOCK:
+        if STARTED:
+            return
+        STARTED = True
+    start_io_loops(write_to_vim=False)
+    plasmaplace_repl_eval.start_repl_read_dispatch_loop(plasmaplace.connection_lost)
+    plasmaplace.start_command_workers()
+    start_keepalive_loop()
+
+
+def stop():
+    """ Closes every nREPL connection, waits a little for them to go out """
+    conns = list(CONNECTIONS.values())
+    for conn in conns:
+        plasmaplace.disconnect(conn)
+    deadline = time.time() + STOP_TIMEOUT
+    while time.time() < deadline and not all(conn.closed for conn in conns):
+        time.sleep(0.01)
+
+
+def _submit(obj):
+    msg = obj[1]
+    verb = plasmaplace._unwrap(msg)[1][0]
+    if verb == "shutdown":
+        stop()
+    elif verb in plasmaplace.SERIAL_VERBS:
+        plasmaplace.run_command_from_vim(obj)
+    else:
+        plasmaplace.queue_command(obj)
+
+
+def send(data):
+    """ data is a JSON encoded command, its reply is left for poll() """
+    _submit([next(MSG_IDS), json.loads(data)])
+
+
+def request(data, timeout_ms):
+    """ Like send() but waits for the reply, "" when it does not come in time """
+    msg_id = next(MSG_IDS)
+    _submit([msg_id, json.loads(data)])
+    deadline = time.time() + int(timeout_ms) / 1000.0
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return ""
+        try:
+            reply_id, msg = TO_VIM_QUEUE.get(timeout=remaining)
+        except Empty:
+            return ""
+        if reply_id == msg_id:
+            return msg
+        PENDING.append(msg)
+
+
+def poll():
+    """ The replies that arrived since the last call, oldest first """
+    ret = []
+    while PENDING and len(ret) < MAX_POLL_MSGS:
+        ret.append(PENDING.popleft())
+    while len(ret) < MAX_POLL_MSGS:
+        try:
+            _, msg = TO_VIM_QUEUE.get_nowait()
+        except Empty:
+            break
+        ret.append(msg)
+    return ret
@@ -1,96 +1,291 @@
 """
 All sockets, input/output queues, loops go here
 """
-import os
 import sys
 import json
 import threading
 import socket
-import uuid
+import selectors
 import time
-from queue import Queue
+import itertools
+from queue import Queue, Empty
 import plasmaplace_utils
-from plasmaplace_utils import bencode, bdecode
+from plasmaplace_utils import bencode_into, BDecoder
+from plasmaplace_stats import STATS
 
-SOCKET = None
-TO_NREPL = Queue()
+
+class TimestampedQueue(Queue):
+    """ A Queue whose get() returns (time the item was put, item) """
+
+    def _put(self, item):
+        super()._put((time.perf_counter(), item))
+
+
+# (connection, payload) for every connection, written by a single thread
+TO_NREPL = TimestampedQueue()
 TO_VIM_QUEUE = Queue()
+# where messages for Vim go, None while no editor is attached
+VIM_OUT = sys.stdout
 EXIT_SIGNAL_QUEUE = Queue()
-EXITING = False
+# project key -> Connection, the key is "" when the daemon serves one project
+CONNECTIONS = {}
+# wakes up the reader so that it picks up added and removed connections
+_WAKEUP_R, _WAKEUP_W = socket.socketpair()
 _debug = plasmaplace_utils._debug
+# a quiet connection is checked after HEARTBEAT_IDLE_S, then less and less
+# often up to every HEARTBEAT_MAX_S until something is received again
+HEARTBEAT_IDLE_S = 5.0
+HEARTBEAT_MAX_S = 60.0
+HEARTBEAT_IDS = itertools.count(1)
+
+
+class Connection:
+    """
+    One nREPL socket and the state of the project that uses it. A daemon has
+    one of these, or any number of them when it is shared between projects.
+    """
+
+    def __init__(self, key, port_file_path, project_type, project_path, timeout_ms):
+        self.key = key
+        self.project_type = project_type
+        self.project_path = project_path
+        self.timeout_ms = int(timeout_ms)
+        with open(port_file_path, "r") as f:
+            port = int(f.read().strip())
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.connect(("localhost", port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setblocking(1)
+        self.decoder = BDecoder(self.sock)
+        self.write_buf = bytearray()
+        self.closed = False
+
+        self.root_session = None
+        # lane name -> session, "primary" is the root session
+        self.sessions = {}
+        self.existing_sessions = []
+        # lane of the last eval that threw, where *e is bound
+        self.last_ex_lane = None
+        # set from the options Vim sends with "init"
+        self.stream_flush_interval = None
+        self.output_limit = None
+        self.interrupt_timeout = None
+        self.request_timeout = None
+
+        # anything received shows the connection is alive, see _keepalive_loop
+        self.last_received = time.time()
+        self.heartbeat = None
+        self.heartbeat_replied = 0.0
+        self.heartbeat_interval = HEARTBEAT_IDLE_S
+
+    def send(self, payload):
+        TO_NREPL.put((self, payload))
+
+    def disconnect(self):
+        """ Closes the connection once everything sent before has gone out. """
+        TO_NREPL.put((self, "disconnect"))
+
+    def to_vim(self, msg_id, msg, do_async=False):
+        to_vim(msg_id, msg, do_async, self.key)
+
+    def receive(self):
+        """ Reads what is available, returns the messages that completes. """
+        decoder = self.decoder
+        n = decoder.recv()
+        self.last_received = time.time()
+        start = time.perf_counter()
+        decoder.feed(decoder.view[:n])
+        STATS.record("nrepl_bdecode", time.perf_counter() - start)
+        STATS.incr("nrepl_bytes_received", n)
+        msgs = list(decoder.messages)
+        decoder.messages.clear()
+        STATS.incr("nrepl_msgs_received", len(msgs))
+        return msgs
+
+    def close(self):
+        """ The socket itself is closed by the reader once it lets go of it. """
+        self.closed = True
+        remove_connection(self)
+        _wakeup_reader()
+
+
+def add_connection(conn):
+    CONNECTIONS[conn.key] = conn
+    _wakeup_reader()
+
+
+def remove_connection(conn):
+    """ conn is no longer found by its key, its socket stays open """
+    if CONNECTIONS.get(conn.key) is conn:
+        del CONNECTIONS[conn.key]
+
+
+def _drain(q, first):
+    items = [first]
+    while True:
+        try:
+            items.append(q.get_nowait())
+        except Empty:
+            return items
 
 
 def _write_to_nrepl_loop():
-    global EXITING
-    try:
-        while True:
-            payload = TO_NREPL.get(block=True)
+    while True:
+        items = _drain(TO_NREPL, TO_NREPL.get(block=True))
+        exiting = False
+        start = time.perf_counter()
+        # payloads for the same connection go out in one write
+        batches = {}
+        closing = []
+        for put_time, (conn, payload) in items:
+            STATS.record("nrepl_queue_wait", start - put_time)
             _debug(payload)
             if payload == "exit":
-                _debug("EXIT_SIGNAL_QUEUE True")
-                EXIT_SIGNAL_QUEUE.put(True)
-                EXITING = True
+                exiting = True
                 break
-            enc_payload = bencode(payload)
-            SOCKET.sendall(bytes(enc_payload, "UTF-8"))
-    except:  # noqa
-        _debug("EXIT_SIGNAL_QUEUE True")
-        EXIT_SIGNAL_QUEUE.put(True)
-        EXITING = True
-        os._exit(1)
+            if payload == "disconnect":
+                closing.append(conn)
+                continue
+            if conn.closed:
+                continue
+            if conn not in batches:
+                del conn.write_buf[:]
+                batches[conn] = 0
+            mark = len(conn.write_buf)
+            try:
+                bencode_into(conn.write_buf, payload)
+            except (TypeError, ValueError) as e:
+                # only this payload is lost, not the thread every connection uses
+                del conn.write_buf[mark:]
+                _debug("cannot bencode payload: %r" % (e,))
+                STATS.incr("nrepl_encode_errors")
+                continue
+            batches[conn] += 1
+        encoded = time.perf_counter()
+        for conn, n in batches.items():
+            try:
+                conn.sock.sendall(conn.write_buf)
+            except OSError:
+                _debug("send to nREPL failed: " + conn.key)
+                # the reader sees the connection end and reports it
+                try:
+                    conn.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                continue
+            STATS.incr("nrepl_msgs_sent", n)
+            STATS.incr("nrepl_bytes_sent", len(conn.write_buf))
+        if batches:
+            STATS.record("nrepl_bencode", encoded - start)
+            STATS.record("nrepl_send", time.perf_counter() - encoded)
+        for conn in closing:
+            conn.close()
+        if exiting:
+            _debug("EXIT_SIGNAL_QUEUE True")
+            EXIT_SIGNAL_QUEUE.put(True)
+            break
 
 
 ################################################################################
 
 
+def set_vim_output(f, expected=None):
+    """ With expected, only replaces the output if it is still that one. """
+    global VIM_OUT
+    if expected is None or VIM_OUT is expected:
+        VIM_OUT = f
+
+
 def _write_to_vim_loop():
     while True:
         payload = TO_VIM_QUEUE.get(block=True)
         _debug(payload)
-        sys.stdout.write(json.dumps(payload))
-        sys.stdout.write("\n")
-        sys.stdout.flush()
+        out = VIM_OUT
+        if out is None:
+            STATS.incr("to_vim_dropped")
+            continue
+        start = time.perf_counter()
+        data = json.dumps(payload)
+        serialized = time.perf_counter()
+        try:
+            out.write(data)
+            out.write("\n")
+            out.flush()
+        except (OSError, ValueError):
+            # the editor detached
+            continue
+        STATS.record("to_vim_serialize", serialized - start)
+        STATS.record("to_vim_write", time.perf_counter() - serialized)
+        STATS.incr("to_vim_bytes", len(data) + 1)
 
 
-def to_vim(msg_id: int, msg, do_async=False):
+def to_vim(msg_id: int, msg, do_async=False, key=""):
+    """ key tells Vim which project msg is for when the daemon is shared """
     if do_async:
         msg_id = 0
         msg["async"] = True
+    if key and isinstance(msg, dict):
+        msg["project_key"] = key
     TO_VIM_QUEUE.put([msg_id, msg])
 
 
 ################################################################################
 
 
+def _heartbeat(conn, now):
+    """ Sends a heartbeat if conn is due one, returns when to look again """
+    if conn.heartbeat is not None:
+        msg_id, sent, _ = conn.heartbeat
+        if now - sent < HEARTBEAT_MAX_S:
+            return sent + HEARTBEAT_MAX_S
+        STATS.incr("heartbeats_unanswered")
+        conn.heartbeat = None
+    if conn.last_received > conn.heartbeat_replied:
+        # other traffic since the last heartbeat, start over
+        conn.heartbeat_interval = HEARTBEAT_IDLE_S
+    due = conn.last_received + conn.heartbeat_interval
+    if now < due:
+        return due
+    msg_id = "keepalive-%d" % (next(HEARTBEAT_IDS),)
+    conn.heartbeat = (msg_id, now, time.perf_counter())
+    conn.heartbeat_interval = min(conn.heartbeat_interval * 2, HEARTBEAT_MAX_S)
+    conn.send({"op": "ls-sessions", "id": msg_id})
+    STATS.incr("heartbeats_sent")
+    return now + HEARTBEAT_MAX_S
+
+
+def heartbeat_reply(conn, msg_id):
+    """ Called by the reader for replies to heartbeats """
+    heartbeat = conn.heartbeat
+    if heartbeat is None or heartbeat[0] != msg_id:
+        STATS.incr("heartbeats_late")
+        return
+    STATS.record("nrepl_rtt.heartbeat", time.perf_counter() - heartbeat[2])
+    conn.heartbeat = None
+    conn.heartbeat_replied = time.time()
+
+
 def _keepalive_loop():
+    """ Only connections that have been quiet for a while are sent anything """
     while True:
-        payload = {
-            "op": "ls-sessions",
-            "id": "keepalive-" + str(uuid.uuid4()),
-        }
-        TO_NREPL.put(payload)
-        time.sleep(1)
+        now = time.time()
+        wake = now + HEARTBEAT_IDLE_S
+        for conn in list(CONNECTIONS.values()):
+            if not conn.closed:
+                wake = min(wake, _heartbeat(conn, now))
+        time.sleep(max(0.1, wake - time.time()))
 
 
-def start_io_loops():
+def start_io_loops(write_to_vim=True):
+    """ write_to_vim is off when Vim takes replies off TO_VIM_QUEUE itself """
     t1 = threading.Thread(target=_write_to_nrepl_loop, daemon=True)
     t1.daemon = True
     t1.start()
 
-    t2 = threading.Thread(target=_write_to_vim_loop, daemon=True)
-    t2.daemon = True
-    t2.start()
-
-
-def connect_to_nrepl_socket(port_file_path: str):
-    global SOCKET
-    with open(port_file_path, "r") as f:
-        port = int(f.read().strip())
-    SOCKET = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    SOCKET.connect(("localhost", port))
-    SOCKET.setblocking(1)
-
-    start_io_loops()
+    if write_to_vim:
+        t2 = threading.Thread(target=_write_to_vim_loop, daemon=True)
+        t2.daemon = True
+        t2.start()
 
 
 def start_keepalive_loop():
@@ -102,10 +297,60 @@ def start_keepalive_loop():
 ################################################################################
 
 
-def read_nrepl_msg():
-    msg = bdecode(SOCKET)
-    _debug(msg)
-    if EXITING:
-        EXIT_SIGNAL_QUEUE.put(True)
-        raise RuntimeError("Exiting...")
-    return msg
+def _wakeup_reader():
+    _WAKEUP_W.send(b"\0")
+
+
+def _sync_registrations(selector, registered):
+    for conn in list(registered):
+        if conn.closed:
+            selector.unregister(conn.sock)
+            registered.discard(conn)
+            conn.sock.close()
+    for conn in list(CONNECTIONS.values()):
+        if conn not in registered and not conn.closed:
+            selector.register(conn.sock, selectors.EVENT_READ, conn)
+            registered.add(conn)
+
+
+def _read_from_nrepl_loop(dispatch, connection_lost):
+    """
+    Waits on every nREPL socket at once. dispatch(conn, msg) is called for
+    every message and connection_lost(conn) when a socket is closed on the
+    other end.
+    """
+    selector = selectors.DefaultSelector()
+    selector.register(_WAKEUP_R, selectors.EVENT_READ, None)
+    registered = set()
+    _sync_registrations(selector, registered)
+    while True:
+        for key, _ in selector.select():
+            conn = key.data
+            if conn is None:
+                _WAKEUP_R.recv(4096)
+                _sync_registrations(selector, registered)
+                continue
+            if conn.closed:
+                continue
+            try:
+                msgs = conn.receive()
+            except (OSError, EOFError, ValueError, TypeError) as e:
+                if not isinstance(e, (OSError, EOFError)):
+                    # what follows can no longer be framed, give up on conn
+                    _debug("bad bencode from nREPL: %r" % (e,))
+                    STATS.incr("nrepl_decode_errors")
+                conn.close()
+                _sync_registrations(selector, registered)
+                connection_lost(conn)
+                continue
+            for msg in msgs:
+                _debug(msg)
+                dispatch(conn, msg)
+
+
+def start_read_loop(dispatch, connection_lost):
+    t1 = threading.Thread(
+        target=_read_from_nrepl_loop, args=(dispatch, connection_lost), daemon=True
+    )
+    t1.daemon = True
+    t1.start()
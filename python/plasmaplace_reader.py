@@ -0,0 +1,240 @@
+__doc__ = """
+A minimal Clojure reader. It mostly does not build any data, it only finds
+where forms begin and end so that a file can be split into its top-level
+forms. read_data() turns a simple form, such as an ns form, into Python data.
+"""
+
+from collections import namedtuple
+
+# start and end are offsets into the text, end exclusive
+# start_line and end_line are 0-based line numbers, both inclusive
+TopLevelForm = namedtuple(
+    "TopLevelForm", ["start", "end", "start_line", "end_line", "text"]
+)
+
+WHITESPACE = " \t\r\n,"
+CLOSING = {"(": ")", "[": "]", "{": "}"}
+DELIMITERS = WHITESPACE + "()[]{}\";"
+
+
+def _skip_whitespace(text, pos):
+    n = len(text)
+    while pos < n:
+        c = text[pos]
+        if c in WHITESPACE:
+            pos += 1
+        elif c == ";":
+            end = text.find("\n", pos)
+            if end < 0:
+                return n
+            pos = end + 1
+        else:
+            break
+    return pos
+
+
+def _read_token(text, pos):
+    n = len(text)
+    while pos < n and text[pos] not in DELIMITERS:
+        pos += 1
+    return pos
+
+
+def _read_string(text, pos):
+    """ pos is just past the opening quote """
+    n = len(text)
+    while pos < n:
+        c = text[pos]
+        if c == "\\":
+            pos += 2
+        elif c == '"':
+            return pos + 1
+        else:
+            pos += 1
+    raise ValueError("unterminated string")
+
+
+def _read_delimited(text, pos, closing):
+    """ pos is just past the opening bracket """
+    while True:
+        pos = _skip_whitespace(text, pos)
+        if pos >= len(text):
+            raise ValueError("unbalanced %s" % (closing,))
+        c = text[pos]
+        if c == closing:
+            return pos + 1
+        if c in ")]}":
+            raise ValueError("unexpected %s" % (c,))
+        pos = _read_form(text, pos)
+
+
+def _read_next(text, pos):
+    pos = _skip_whitespace(text, pos)
+    if pos >= len(text):
+        raise ValueError("unexpected end of input")
+    return _read_form(text, pos)
+
+
+def _read_form(text, pos):
+    """ Returns the offset just past the form that starts at pos. """
+    c = text[pos]
+    if c in CLOSING:
+        return _read_delimited(text, pos + 1, CLOSING[c])
+    if c in ")]}":
+        raise ValueError("unexpected %s" % (c,))
+    if c == '"':
+        return _read_string(text, pos + 1)
+    if c == "\\":
+        # character literal, the first character may be a delimiter: \( \space
+        return _read_token(text, pos + 2)
+    if c in "'`@":
+        return _read_next(text, pos + 1)
+    if c == "~":
+        if text.startswith("~@", pos):
+            return _read_next(text, pos + 2)
+        return _read_next(text, pos + 1)
+    if c == "^":
+        # metadata and then the form it is attached to
+        return _read_next(text, _read_next(text, pos + 1))
+    if c == "#":
+        d = text[pos + 1:pos + 2]
+        if d in ("{", "("):
+            return _read_form(text, pos + 1)
+        if d == '"':
+            return _read_string(text, pos + 2)
+        if d in ("'", "_", "="):
+            return _read_next(text, pos + 2)
+        if d == "?":
+            if text.startswith("#?@", pos):
+                return _read_next(text, pos + 3)
+            return _read_next(text, pos + 2)
+        if d == ":":
+            # namespaced map #:foo{...}
+            return _read_next(text, _read_token(text, pos + 2))
+        if d == "#":
+            # ##Inf ##NaN
+            return _read_token(text, pos + 2)
+        # tagged literal #inst "..."
+        return _read_next(text, _read_token(text, pos + 1))
+    return _read_token(text, pos + 1)
+
+
+def top_level_forms(text):
+    """
+    Splits text into its top-level forms. Raises ValueError when the text
+    cannot be read, e.g. when brackets are unbalanced.
+    """
+    forms = []
+    line_starts = [0]
+    idx = text.find("\n")
+    while idx >= 0:
+        line_starts.append(idx + 1)
+        idx = text.find("\n", idx + 1)
+
+    line = 0
+    pos = _skip_whitespace(text, 0)
+    while pos < len(text):
+        end = _read_form(text, pos)
+        while line + 1 < len(line_starts) and line_starts[line + 1] <= pos:
+            line += 1
+        start_line = line
+        while line + 1 < len(line_starts) and line_starts[line + 1] < end:
+            line += 1
+        forms.append(TopLevelForm(pos, end, start_line, line, text[pos:end]))
+        pos = _skip_whitespace(text, end)
+    return forms
+
+
+class List(list):
+    """ (a b c) """
+
+
+class Vector(list):
+    """ [a b c] """
+
+
+class Map(list):
+    """ {k v ...}, kept as a flat list of keys and values """
+
+
+class Set(list):
+    """ #{a b c} """
+
+
+class String(str):
+    """ A string literal, symbols, keywords and numbers are plain str """
+
+
+class ReaderConditional(list):
+    """ #?(:clj a :cljs b) as [":clj", a, ":cljs", b], splicing for #?@ """
+
+    def __init__(self, items, splicing):
+        super().__init__(items)
+        self.splicing = splicing
+
+
+# what #_ reads as, it is dropped from the enclosing form
+_DISCARD = object()
+_COLLECTIONS = {"(": List, "[": Vector, "{": Map}
+
+
+def _unescape(text):
+    return text.replace('\\"', '"').replace("\\\\", "\\")
+
+
+def _read_data_delimited(text, pos, closing, cls):
+    items = cls()
+    while True:
+        pos = _skip_whitespace(text, pos)
+        if pos >= len(text):
+            raise ValueError("unbalanced %s" % (closing,))
+        if text[pos] == closing:
+            return items, pos + 1
+        value, pos = _read_data_next(text, pos)
+        if value is not _DISCARD:
+            items.append(value)
+
+
+def _read_data_next(text, pos):
+    pos = _skip_whitespace(text, pos)
+    if pos >= len(text):
+        raise ValueError("unexpected end of input")
+    c = text[pos]
+    if c in _COLLECTIONS:
+        return _read_data_delimited(text, pos + 1, CLOSING[c], _COLLECTIONS[c])
+    if c in ")]}":
+        raise ValueError("unexpected %s" % (c,))
+    if c == '"':
+        end = _read_string(text, pos + 1)
+        return String(_unescape(text[pos + 1:end - 1])), end
+    if c == "'":
+        value, end = _read_data_next(text, pos + 1)
+        return List(["quote", value]), end
+    if c == "^":
+        # metadata is dropped
+        _, end = _read_data_next(text, pos + 1)
+        return _read_data_next(text, end)
+    if c == "#":
+        d = text[pos + 1:pos + 2]
+        if d == "{":
+            items, end = _read_data_delimited(text, pos + 2, "}", Set)
+            return items, end
+        if d == "_":
+            _, end = _read_data_next(text, pos + 2)
+            return _DISCARD, end
+        if d == "?":
+            splicing = text.startswith("#?@", pos)
+            start = pos + (3 if splicing else 2)
+            items, end = _read_data_next(text, start)
+            return ReaderConditional(items, splicing), end
+    # everything else is kept as the text it was read from
+    end = _read_form(text, pos)
+    return text[pos:end], end
+
+
+def read_data(text, pos=0):
+    """ Reads the form at or after pos, returns (data, offset past it) """
+    value, end = _read_data_next(text, pos)
+    while value is _DISCARD:
+        value, end = _read_data_next(text, end)
+    return value, end
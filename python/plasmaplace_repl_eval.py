@@ -6,26 +6,145 @@ evaluate and receiving the value, output, error, exception, and stack trace.
 import sys
 import uuid
 import ast
+import time
+import mmap
+import tempfile
 import threading
-from queue import Queue
-from plasmaplace_io import TO_NREPL, read_nrepl_msg, _debug
+from queue import Queue, Empty
+from plasmaplace_io import start_read_loop, heartbeat_reply, _debug
+from plasmaplace_utils import LRUCache
+from plasmaplace_stats import STATS
+
+INTERRUPTED = ";; INTERRUPTED, output above is partial"
+OUTPUT_PAST_LIMIT = ";; OUTPUT PAST THE LIMIT:"
+NOT_INTERRUPTED = ";; NOT INTERRUPTED, nREPL had not started it yet"
+# an interrupt that nREPL refused because the eval was not the one running
+INTERRUPT_REJECTED = ("interrupt-id-mismatch", "session-idle")
+# how much of the streamed output a StreamSink remembers
+SINK_SHOWN_MAX_LINES = 1000
+STACKTRACE_HINT = ";; :PlasmaplaceStacktrace for the stack trace, ! for project frames"
+SEPARATOR = (
+    ";;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;"
+)
+
+
+class SpilledOutput:
+    """
+    Output past the size limit goes to a temporary file instead of memory.
+    Vim is only sent its head and tail, the part in between is fetched a page
+    at a time with the "more" verb.
+    """
+    instances = LRUCache(16)
+    last_handle = None
+
+    def __init__(self, limit):
+        self.handle = uuid.uuid4().hex[:8]
+        self.limit = limit
+        self.file = tempfile.TemporaryFile(prefix="plasmaplace-")
+        self.size = 0
+        self.data = None
+        self.preview = None
+        self.next_offset = 0
+        self.tail_offset = 0
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        data = text.encode("utf-8")
+        self.file.write(data)
+        self.size += len(data)
+
+    def _lines(self, start, end):
+        lines = self.data[start:end].decode("utf-8", "replace").split("\n")
+        if len(lines) > 1 and lines[-1] == "":
+            lines.pop()
+        return lines
+
+    def _omitted_line(self):
+        return ";; ... %s omitted, :PlasmaplaceMore %s shows the next %s" % (
+            _fmt_size(self.tail_offset - self.next_offset),
+            self.handle,
+            _fmt_size(self.limit),
+        )
+
+    def get_preview_lines(self):
+        """ Head and tail of the output, split on line boundaries. """
+        if self.preview is not None:
+            return self.preview
+        self.file.flush()
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        half = self.limit // 2
+        head_end = self.data.rfind(b"\n", 0, half) + 1 or half
+        tail_start = self.data.find(b"\n", self.size - half) + 1
+        if tail_start == 0:
+            tail_start = self.size - half
+        self.next_offset = head_end
+        self.tail_offset = tail_start
+
+        self.preview = self._lines(0, head_end)
+        self.preview.append(self._omitted_line())
+        self.preview += self._lines(tail_start, self.size)
+        SpilledOutput.instances.put(self.handle, self)
+        SpilledOutput.last_handle = self.handle
+        STATS.incr("output_spilled")
+        STATS.incr("output_spilled_bytes", self.size)
+        return self.preview
+
+    def next_page(self):
+        with self.lock:
+            start = self.next_offset
+            if start >= self.tail_offset:
+                return [";; no more omitted output in %s" % (self.handle,)]
+            end = min(start + self.limit, self.tail_offset)
+            if end < self.tail_offset:
+                newline = self.data.rfind(b"\n", start, end)
+                if newline >= 0:
+                    end = newline + 1
+            self.next_offset = end
+            lines = self._lines(start, end)
+            if end < self.tail_offset:
+                lines.append(self._omitted_line())
+            else:
+                lines.append(";; ... end of the omitted output of %s" % (self.handle,))
+            return lines
+
+
+def _fmt_size(n):
+    if n < 1024:
+        return "%d bytes" % (n,)
+    if n < 1024 * 1024:
+        return "%.1f KiB" % (n / 1024.0,)
+    return "%.1f MiB" % (n / (1024.0 * 1024.0),)
 
 
 class StreamBuffer:
     """
     An utility class used to convert stream data to lines or a string for
-    value interpretation
+    value interpretation. Once more than limit characters have been appended
+    everything is spilled to disk.
     """
-    def __init__(self, header):
+    def __init__(self, header, limit=None):
         self.header = header
         self.appended_header = False
         self.value = None
         self.buf = []
+        self.limit = limit
+        self.size = 0
+        self.spill = None
 
     def append(self, msg):
+        if self.spill is not None:
+            self.spill.write(msg)
+            return
         self.buf.append(msg)
+        self.size += len(msg)
+        if self.limit is not None and self.size > self.limit:
+            self.spill = SpilledOutput(self.limit)
+            self.spill.write("".join(self.buf))
+            self.buf = []
 
     def get_lines(self):
+        if self.spill is not None:
+            return [self.header] + self.spill.get_preview_lines()
         if len(self.buf) == 0:
             return []
         ret = []
@@ -43,6 +162,69 @@ class StreamBuffer:
         return self.value
 
 
+class StreamSink:
+    """
+    Forwards output to Vim while the form is still running instead of when it
+    is done. Chunks are coalesced so that at most one message is sent per flush
+    interval, and only complete lines are sent until the final flush.
+    """
+    def __init__(self, conn, eval_id, flush_interval):
+        self.conn = conn
+        self.eval_id = eval_id
+        self.flush_interval = flush_interval
+        self.header = None
+        self.partial = ""
+        self.lines = []
+        # the first lines that were sent, for the history
+        self.shown = []
+        self.flushed = False
+        self.last_flush = 0.0
+
+    def _end_line(self):
+        if self.partial:
+            self.lines.append(self.partial)
+            self.partial = ""
+
+    def add_lines(self, lines):
+        self._end_line()
+        self.lines += lines
+
+    def append(self, stream, text, whole=False):
+        if stream.header != self.header:
+            self._end_line()
+            self.header = stream.header
+            self.lines.append(stream.header)
+        parts = (self.partial + text).split("\n")
+        self.partial = parts.pop()
+        self.lines += parts
+        if whole:
+            self._end_line()
+
+    def timeout(self):
+        """ Seconds until the next flush is due, None if nothing is pending. """
+        if not self.lines:
+            return None
+        return max(0.0, self.last_flush + self.flush_interval - time.time())
+
+    def flush(self, final=False):
+        if final:
+            self._end_line()
+        if not self.lines:
+            return
+        room = SINK_SHOWN_MAX_LINES - len(self.shown)
+        if room > 0:
+            self.shown += self.lines[:room]
+        msg = {"lines": self.lines, "stream": self.eval_id, "skip_center": self.flushed}
+        self.conn.to_vim(0, msg)
+        self.flushed = True
+        self.lines = []
+        self.last_flush = time.time()
+
+    def maybe_flush(self):
+        if self.timeout() == 0.0:
+            self.flush()
+
+
 def literal_eval(value):
     if value is None or value == "":
         return None
@@ -52,23 +234,215 @@ def literal_eval(value):
     return ast.literal_eval(value)
 
 
+class TooBusy(RuntimeError):
+    """ Raised instead of sending a request when too many are in flight """
+
+
+class PendingRequest:
+    __slots__ = ("id", "conn", "queue", "timeout", "deadline", "owner")
+
+    def __init__(self, msg_id, conn, queue, timeout, owner):
+        self.id = msg_id
+        self.conn = conn
+        self.queue = queue
+        # seconds without a reply after which nREPL is given up on
+        self.timeout = timeout
+        self.deadline = None if timeout is None else time.time() + timeout
+        # the ReplEval waiting for the replies, None for other ops
+        self.owner = owner
+
+    def fail(self, reason):
+        """ Ends the wait for replies that are not coming """
+        if self.owner is not None:
+            self.queue.put({"err": ";; %s\n" % (reason,)})
+            self.queue.put({"status": ["done"]})
+        else:
+            self.queue.put({"status": ["done", "error"]})
+
+
+class RequestTable:
+    """
+    Every request that replies are still expected for, by id. A request that
+    gets no reply within its timeout is failed by sweep(), replies that come
+    after that are counted as orphaned.
+    """
+
+    def __init__(self, max_per_conn):
+        self.max_per_conn = max_per_conn
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.per_conn = {}
+        # ids that were answered or given up on, to tell late replies apart
+        self.finished = LRUCache(1024)
+
+    def add(self, conn, msg_id, queue, timeout=None, owner=None):
+        with self.lock:
+            n = self.per_conn.get(conn, 0)
+            if n >= self.max_per_conn:
+                STATS.incr("requests_rejected")
+                raise TooBusy("%d requests in flight" % (n,))
+            self.per_conn[conn] = n + 1
+            entry = PendingRequest(msg_id, conn, queue, timeout, owner)
+            self.pending[msg_id] = entry
+        return entry
+
+    def remove(self, msg_id):
+        with self.lock:
+            entry = self.pending.pop(msg_id, None)
+            if entry is None:
+                return None
+            n = self.per_conn[entry.conn] - 1
+            if n:
+                self.per_conn[entry.conn] = n
+            else:
+                del self.per_conn[entry.conn]
+        self.finished.put(msg_id, True)
+        return entry
+
+    def dispatch(self, msg_id, msg):
+        entry = self.pending.get(msg_id)
+        if entry is not None:
+            if entry.timeout is not None:
+                entry.deadline = time.time() + entry.timeout
+            entry.queue.put(msg)
+        elif self.finished.get(msg_id):
+            STATS.incr("nrepl_msgs_orphaned")
+        else:
+            STATS.incr("nrepl_msgs_unknown_id")
+
+    def entries(self, conn=None):
+        with self.lock:
+            return [x for x in self.pending.values() if conn in (None, x.conn)]
+
+    def owners(self, conn=None):
+        return [x.owner for x in self.entries(conn) if x.owner is not None]
+
+    def abandon(self, conn, reason):
+        """ Fails every request of conn, nothing more is read from it """
+        for entry in self.entries(conn):
+            if self.remove(entry.id) is not None:
+                entry.fail(reason)
+
+    def sweep(self):
+        now = time.time()
+        for entry in self.entries():
+            if entry.conn.closed:
+                # in case a way of closing it forgot about what was in flight
+                if self.remove(entry.id) is not None:
+                    STATS.incr("requests_expired")
+                    entry.fail("nREPL connection closed")
+            elif entry.deadline is not None and entry.deadline <= now:
+                if self.remove(entry.id) is None:
+                    continue
+                STATS.incr("requests_expired")
+                reason = "no reply from nREPL for %ds, stopped waiting" % (
+                    entry.timeout,
+                )
+                entry.fail(reason)
+        with self.lock:
+            STATS.gauge("requests_pending", len(self.pending))
+
+
 class ReplEval:
     """ The main class used to perform NREPL op 'eval'. """
-    root_session = ""
-    instances = {}
+    requests = RequestTable(64)
+    interrupt_grace = 2.0
+    changed_namespaces_listeners = []
 
     @staticmethod
     def dispatch_msg(msg_id, msg):
-        if msg_id in ReplEval.instances:
-            this = ReplEval.instances[msg_id]
-            this.from_repl.put(msg)
+        ReplEval.requests.dispatch(msg_id, msg)
 
     @staticmethod
-    def set_root_session(root_session):
-        ReplEval.root_session = root_session
+    def set_stream_flush_interval(conn, flush_ms):
+        """ None disables streaming of output to Vim. """
+        if flush_ms is None:
+            conn.stream_flush_interval = None
+        else:
+            conn.stream_flush_interval = int(flush_ms) / 1000.0
 
     @staticmethod
-    def is_done_msg(msg):
+    def set_output_limit(conn, limit_bytes):
+        """ None or 0 keeps all output in memory and sends all of it to Vim. """
+        if not limit_bytes:
+            conn.output_limit = None
+        else:
+            conn.output_limit = max(1024, int(limit_bytes))
+
+    @staticmethod
+    def set_interrupt_timeout(conn, timeout_ms):
+        """ None disables interrupting evaluations that run for too long. """
+        if timeout_ms is None:
+            conn.interrupt_timeout = None
+        else:
+            conn.interrupt_timeout = int(timeout_ms) / 1000.0
+
+    @staticmethod
+    def set_request_timeout(conn, timeout_s):
+        """ None or 0 waits for as long as nREPL takes to reply. """
+        if not timeout_s:
+            conn.request_timeout = None
+        else:
+            conn.request_timeout = float(timeout_s)
+
+    @staticmethod
+    def interrupt_all(conn):
+        """ Interrupt every evaluation in flight, returns how many there were. """
+        instances = ReplEval.requests.owners(conn)
+        for this in instances:
+            this.interrupt()
+        return len(instances)
+
+    @staticmethod
+    def abandon_all(conn, reason="nREPL connection lost"):
+        """ Stop waiting for replies that can no longer arrive. """
+        ReplEval.requests.abandon(conn, reason)
+
+    @staticmethod
+    def request(conn, payload):
+        """
+        Sends an op other than eval and returns all of its replies merged into
+        one dict.
+        """
+        msg_id = str(uuid.uuid4())
+        payload["id"] = msg_id
+        q = Queue()
+        ReplEval.requests.add(conn, msg_id, q, conn.timeout_ms / 1000.0)
+        ret = {}
+        try:
+            conn.send(payload)
+            while True:
+                try:
+                    msg = q.get(timeout=conn.timeout_ms / 1000.0)
+                except Empty:
+                    raise RuntimeError("nREPL did not reply to " + payload["op"])
+                ret.update(msg)
+                if ReplEval.is_done_msg(msg):
+                    return ret
+        finally:
+            ReplEval.requests.remove(msg_id)
+
+    @staticmethod
+    def clone_session(conn, lane):
+        """ Adds a lane to conn, a copy of its root session. """
+        if lane in conn.sessions:
+            return conn.sessions[lane]
+        with STATS.timer("nrepl_rtt.clone"):
+            payload = {"op": "clone", "session": conn.root_session}
+            msg = ReplEval.request(conn, payload)
+        conn.sessions[lane] = msg["new-session"]
+        return conn.sessions[lane]
+
+    @staticmethod
+    def add_changed_namespaces_listener(f):
+        """
+        f is called with the connection and the names nREPL reports in
+        changed-namespaces
+        """
+        ReplEval.changed_namespaces_listeners.append(f)
+
+    @staticmethod
+    def has_status(msg, status_name):
         if not isinstance(msg, dict):
             return False
         if "status" not in msg:
@@ -76,96 +450,263 @@ class ReplEval:
         status = msg["status"]
         if not isinstance(status, list):
             return False
-        return status[0] == "done"
+        return status_name in status
 
-    def __init__(self, code, eval_value=False, echo_code=False, silent=False):
+    @staticmethod
+    def is_done_msg(msg):
+        return ReplEval.has_status(msg, "done")
+
+    def __init__(
+        self,
+        conn,
+        code,
+        eval_value=False,
+        echo_code=False,
+        silent=False,
+        stream=False,
+        interruptible=False,
+        ns=None,
+        lane="primary",
+        position=None,
+    ):
         self.id = str(uuid.uuid4())
+        self.conn = conn
+        # lanes fall back to the root session when they were not cloned
+        self.lane = lane
+        self.session = conn.sessions.get(lane) or conn.root_session
         self.from_repl = Queue()
-        ReplEval.instances[self.id] = self
 
         self.echo_code = echo_code
         self.eval_value = eval_value
         self.silent = silent
         self.code = code
+        self.ns = ns
+        # (file, line, column) that code is from, for the metadata of defs
+        self.position = position
 
         self.success = False
         self.ex_happened = False
-
-        self.value_stream = StreamBuffer(";; VALUE:")
-        self.out_stream = StreamBuffer(";; OUT:")
-        self.err_stream = StreamBuffer(";; ERR:")
+        self.interrupted = False
+
+        self.interrupt_timeout = conn.interrupt_timeout if interruptible else None
+        self.deadline = None
+        if self.interrupt_timeout is not None:
+            self.deadline = time.time() + self.interrupt_timeout
+        self.interrupt_sent = False
+        self.interrupt_rejected = False
+
+        limit = conn.output_limit
+        # values that are read back in Python have to be complete
+        value_limit = None if eval_value else limit
+        self.value_stream = StreamBuffer(";; VALUE:", value_limit)
+        self.out_stream = StreamBuffer(";; OUT:", limit)
+        self.err_stream = StreamBuffer(";; ERR:", limit)
         self.ex_stream = StreamBuffer(";; EX:")
-        self.st_stream = StreamBuffer(";; STACK TRACE:")
         self.unknown_stream = StreamBuffer(";; UNKNOWN REPL RESPONSE:")
 
         self.raw_value = None
 
-        self._eval()
-        self._fetch_stacktrace()
+        self.sink = None
+        # once streamed output is past the limit, the rest is kept in the
+        # buffers of its streams instead, in the order they overflowed
+        self.streamed = 0
+        self.overflow = None
+        if stream and not silent and conn.stream_flush_interval is not None:
+            self.sink = StreamSink(conn, self.id, conn.stream_flush_interval)
+
+        ReplEval.requests.add(conn, self.id, self.from_repl, conn.request_timeout, self)
+        try:
+            self._eval()
+        finally:
+            ReplEval.requests.remove(self.id)
+        if self.sink:
+            if self.overflow is not None:
+                self.sink.add_lines([OUTPUT_PAST_LIMIT])
+                for stream in self.overflow:
+                    self.sink.add_lines(stream.get_lines())
+            self.sink.add_lines(self._ex_lines())
+            if self.interrupted:
+                self.sink.add_lines([INTERRUPTED])
+            elif self.interrupt_rejected:
+                self.sink.add_lines([NOT_INTERRUPTED])
+            self.sink.flush(final=True)
+
+    def interrupt(self):
+        if self.interrupt_sent:
+            return
+        self.interrupt_sent = True
+        payload = {
+            "op": "interrupt",
+            "session": self.session,
+            "id": "interrupt-" + self.id,
+            "interrupt-id": self.id,
+        }
+        self.conn.send(payload)
+        # give nREPL a little while to report "done" before giving up on it
+        self.deadline = time.time() + ReplEval.interrupt_grace
+        self.from_repl.put(None)
 
-    def __del__(self):
-        del ReplEval.instances[self.id]
+    @staticmethod
+    def interrupt_replied(msg_id, msg):
+        """ Tells the eval whose interrupt nREPL refused, see _get_msg() """
+        if any(ReplEval.has_status(msg, x) for x in INTERRUPT_REJECTED):
+            eval_id = msg_id[len("interrupt-"):]
+            ReplEval.requests.dispatch(eval_id, {"interrupt-rejected": True})
+
+    def _interrupt_rejected(self):
+        """
+        The eval was still queued behind another one in the session, it runs
+        when its turn comes and is waited for as if it was never interrupted
+        """
+        self.interrupt_sent = False
+        self.interrupt_rejected = True
+        self.deadline = None
+        if self.interrupt_timeout is not None:
+            self.deadline = time.time() + self.interrupt_timeout
+
+    def _append(self, stream, text, whole=False):
+        if self.sink:
+            limit = self.conn.output_limit
+            if (
+                self.overflow is None
+                and limit is not None
+                and self.streamed + len(text) > limit
+            ):
+                self.overflow = []
+            if self.overflow is not None:
+                if stream not in self.overflow:
+                    self.overflow.append(stream)
+                stream.append(text)
+                return
+            self.streamed += len(text)
+            self.sink.append(stream, text, whole)
+            self.sink.maybe_flush()
+        else:
+            stream.append(text)
+
+    def _get_timeout(self):
+        timeouts = []
+        if self.sink and self.sink.timeout() is not None:
+            timeouts.append(self.sink.timeout())
+        if self.deadline is not None:
+            timeouts.append(max(0.0, self.deadline - time.time()))
+        if not timeouts:
+            return None
+        return min(timeouts)
+
+    def _get_msg(self):
+        while True:
+            try:
+                msg = self.from_repl.get(timeout=self._get_timeout())
+                if msg is not None and "interrupt-rejected" in msg:
+                    self._interrupt_rejected()
+                elif msg is not None:
+                    return msg
+            except Empty:
+                pass
+            if self.sink:
+                self.sink.maybe_flush()
+            if self.deadline is not None and time.time() >= self.deadline:
+                if not self.interrupt_sent:
+                    self.interrupt()
+                else:
+                    # nREPL never acknowledged the interrupt, stop waiting
+                    self.interrupted = True
+                    return {"id": self.id, "status": ["done"]}
+
+    def _create_ns(self):
+        """ Fallback for when nREPL reports the namespace does not exist yet. """
+        payload = {
+            "op": "eval",
+            "session": self.session,
+            "id": self.id,
+            "code": "(in-ns '%s)" % (self.ns,),
+        }
+        self.conn.send(payload)
+        while True:
+            msg = self._get_msg()
+            if ReplEval.is_done_msg(msg):
+                break
 
     def _eval(self):
         payload = {
             "op": "eval",
-            "session": ReplEval.root_session,
+            "session": self.session,
             "id": self.id,
             "code": self.code,
         }
-        TO_NREPL.put(payload)
+        if self.position is not None:
+            payload["file"], payload["line"], payload["column"] = self.position
+        if self.sink:
+            self.sink.add_lines([SEPARATOR])
+            if self.echo_code:
+                self.sink.add_lines(self.code.split("\n"))
+            self.sink.flush()
+        if self.ns:
+            # evaluating in the right namespace costs nothing extra when nREPL
+            # is told about it in the same message, and nREPL puts the session
+            # back in its own namespace afterwards
+            payload["ns"] = self.ns
+        self.conn.send(payload)
+        sent = time.perf_counter()
+        first_response = True
         self.success = True
         while True:
-            msg = self.from_repl.get()
+            msg = self._get_msg()
+            if first_response:
+                STATS.record("nrepl_first_response.eval", time.perf_counter() - sent)
+                first_response = False
+            if ReplEval.has_status(msg, "namespace-not-found"):
+                payload.pop("ns", None)
+                self._create_ns()
+                self.conn.send(payload)
+                continue
+            if ReplEval.has_status(msg, "interrupted"):
+                self.interrupted = True
+                self.success = False
             if ReplEval.is_done_msg(msg):
+                STATS.record("nrepl_rtt.eval", time.perf_counter() - sent)
                 break
 
             if "out" in msg:
-                self.out_stream.append(msg["out"])
+                self._append(self.out_stream, msg["out"])
             elif "value" in msg:
-                self.value_stream.append(msg["value"])
+                self._append(self.value_stream, msg["value"], whole=True)
             elif "err" in msg:
-                self.err_stream.append(msg["err"])
+                self._append(self.err_stream, msg["err"])
                 self.success = False
             elif "ex" in msg:
                 self.success = False
                 self.ex_happened = True
                 self.ex_stream.append(msg["ex"])
+                # *e is only bound in the session the exception happened in
+                self.conn.last_ex_lane = self.lane
             elif "changed-namespaces" in msg:
+                names = list(msg["changed-namespaces"])
+                for f in ReplEval.changed_namespaces_listeners:
+                    f(self.conn, names)
+            elif ReplEval.has_status(msg, "interrupted"):
                 pass
             else:
                 # ignore silent due to probably an error or unhandled case
-                self.unknown_stream.append(str(msg))
+                self._append(self.unknown_stream, str(msg), whole=True)
 
         if self.eval_value:
             value = self.value_stream.get_value()
             value = literal_eval(value)
             self.raw_value = value
 
-    def _fetch_stacktrace(self):
-        if not self.ex_happened:
-            return
-
-        payload = {
-            "op": "eval",
-            "session": ReplEval.root_session,
-            "id": self.id,
-            "code": "*e",
-        }
-        TO_NREPL.put(payload)
-        while True:
-            msg = self.from_repl.get()
-            if ReplEval.is_done_msg(msg):
-                break
-
-            if "value" in msg:
-                value = msg["value"]
-                self.st_stream.append(value)
-            else:
-                # ignore silent due to probably an error or unhandled case
-                self.unknown_stream.append(str(msg))
+    def _ex_lines(self):
+        """ The exception class, the stack trace is only fetched on request """
+        if not self.ex_happened or self.interrupted:
+            return []
+        return self.ex_stream.get_lines() + [STACKTRACE_HINT]
 
     def extract_output(self):
+        with STATS.timer("extract_output"):
+            return self._extract_output()
+
+    def _extract_output(self):
         lines = []
         if self.echo_code:
             lines += self.code.split("\n")
@@ -177,16 +718,31 @@ class ReplEval:
             else:
                 lines += self.value_stream.get_lines()
         lines += self.err_stream.get_lines()
-        lines += self.st_stream.get_lines()
+        lines += self._ex_lines()
+        if self.interrupted:
+            lines.append(INTERRUPTED)
+        elif self.interrupt_rejected:
+            lines.append(NOT_INTERRUPTED)
         return lines
 
+    def output_lines(self):
+        """ The output Vim was shown, without the separator and echoed code """
+        echoed = len(self.code.split("\n")) if self.echo_code else 0
+        if self.sink:
+            return self.sink.shown[1 + echoed:]
+        return self.extract_output()[echoed:]
+
     def to_scratch_buf(self):
+        if self.sink:
+            # everything has already been streamed, only mark completion
+            return {
+                "lines": [],
+                "stream_done": self.id,
+                "ex_happened": self.ex_happened,
+            }
         lines = self.extract_output()
         if not self.silent:
-            lines.insert(
-                0,
-                ";;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;",
-            )
+            lines.insert(0, SEPARATOR)
         return {"lines": lines, "ex_happened": self.ex_happened}
 
     def to_popup(self):
@@ -197,22 +753,27 @@ class ReplEval:
         return {"value": self.raw_value, "ex_happened": self.ex_happened}
 
 
-def _repl_read_dispatch_loop():
-    try:
-        while True:
-            msg = read_nrepl_msg()
-            if not isinstance(msg, dict):
-                continue
-            msg_id = msg["id"]
-            if msg_id.startswith("keepalive-"):
-                continue
-            # _debug(msg)
-            ReplEval.dispatch_msg(msg_id, msg)
-    except:
-        pass
+def _dispatch(conn, msg):
+    if not isinstance(msg, dict):
+        return
+    msg_id = msg.get("id", "")
+    if msg_id.startswith("keepalive-"):
+        heartbeat_reply(conn, msg_id)
+        return
+    if msg_id.startswith("interrupt-"):
+        ReplEval.interrupt_replied(msg_id, msg)
+        return
+    ReplEval.dispatch_msg(msg_id, msg)
+
+
+def _sweep_loop():
+    while True:
+        time.sleep(1)
+        ReplEval.requests.sweep()
 
 
-def start_repl_read_dispatch_loop():
-    t1 = threading.Thread(target=_repl_read_dispatch_loop, daemon=True)
+def start_repl_read_dispatch_loop(connection_lost):
+    start_read_loop(_dispatch, connection_lost)
+    t1 = threading.Thread(target=_sweep_loop, daemon=True)
     t1.daemon = True
     t1.start()
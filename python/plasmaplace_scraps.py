@@ -19,3 +19,54 @@ def vim_encode(data):
         return str(data)
     else:
         raise TypeError("can't encode a " + type(data).__name__)
+
+
+def read_socket(sock, n):
+    data = b""
+    rem = n
+    while True:
+        new_data = sock.recv(rem)
+        data += new_data
+        if len(new_data) == 0:
+            if len(data) == 0:
+                raise EOFError()
+            return data
+        rem -= len(new_data)
+
+
+def bdecode(sock, char=None):
+    if char is None:
+        char = read_socket(sock, 1)
+    if char == b"l":
+        _list = []
+        while True:
+            char = read_socket(sock, 1)
+            if char == b"e":
+                return _list
+            _list.append(bdecode(sock, char))
+    elif char == b"d":
+        d = {}
+        while True:
+            char = read_socket(sock, 1)
+            if char == b"e":
+                return d
+            key = bdecode(sock, char)
+            d[key] = bdecode(sock)
+    elif char == b"i":
+        i = b""
+        while True:
+            char = read_socket(sock, 1)
+            if char == b"e":
+                return int(i.decode("utf-8"))
+            i += char
+    elif char.isdigit():
+        i = int(char)
+        while True:
+            char = read_socket(sock, 1)
+            if char == b":":
+                return read_socket(sock, i).decode("utf-8")
+            i = 10 * i + int(char)
+    elif char == "":
+        raise EOFError("unexpected end of bdecode data")
+    else:
+        raise TypeError("unexpected type " + char + "in bdecode data")
@@ -0,0 +1,132 @@
+__doc__ = """
+Always-on counters and latency histograms for every stage a command goes
+through, cheap enough to record on every message.
+"""
+
+import math
+import time
+import threading
+from contextlib import contextmanager
+
+MIN_SECONDS = 1e-6
+GROWTH = 1.1
+LOG_GROWTH = math.log(GROWTH)
+# 1us to ~20 minutes with ~10% relative error
+NUM_BUCKETS = int(math.log(1200 / MIN_SECONDS) / LOG_GROWTH) + 1
+
+
+class Histogram:
+    """ Log-bucketed histogram of durations in seconds. """
+
+    def __init__(self):
+        self.buckets = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        if seconds <= MIN_SECONDS:
+            idx = 0
+        else:
+            idx = int(math.log(seconds / MIN_SECONDS) / LOG_GROWTH)
+            idx = min(NUM_BUCKETS - 1, idx)
+        self.buckets[idx] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """ Upper bound of the bucket the p-th percentile falls in. """
+        if self.count == 0:
+            return 0.0
+        rank = math.ceil(self.count * p / 100.0)
+        seen = 0
+        for idx, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(self.max, MIN_SECONDS * GROWTH ** (idx + 1))
+        return self.max
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def record(self, name, seconds):
+        with self.lock:
+            h = self.histograms.get(name)
+            if h is None:
+                h = self.histograms[name] = Histogram()
+            h.record(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+    def report_lines(self):
+        with self.lock:
+            uptime = time.time() - self.started
+            lines = [";; plasmaplace stats, %s since start or reset" % _fmt(uptime)]
+            if self.histograms:
+                lines.append(";; LATENCY:")
+                header = "%-28s %8s %9s %9s %9s %9s" % (
+                    "stage", "count", "p50", "p95", "p99", "max"
+                )
+                lines.append(header)
+                for name in sorted(self.histograms):
+                    h = self.histograms[name]
+                    lines.append(
+                        "%-28s %8d %9s %9s %9s %9s"
+                        % (
+                            name,
+                            h.count,
+                            _fmt(h.percentile(50)),
+                            _fmt(h.percentile(95)),
+                            _fmt(h.percentile(99)),
+                            _fmt(h.max),
+                        )
+                    )
+            if self.counters:
+                lines.append(";; COUNTERS:")
+                for name in sorted(self.counters):
+                    lines.append("%-28s %8d" % (name, self.counters[name]))
+            if self.gauges:
+                lines.append(";; GAUGES:")
+                for name in sorted(self.gauges):
+                    lines.append("%-28s %8s" % (name, self.gauges[name]))
+            return lines
+
+
+def _fmt(seconds):
+    if seconds < 1e-3:
+        return "%.0fus" % (seconds * 1e6)
+    if seconds < 1.0:
+        return "%.1fms" % (seconds * 1e3)
+    return "%.2fs" % (seconds,)
+
+
+STATS = Stats()
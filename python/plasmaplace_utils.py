@@ -1,5 +1,10 @@
 import re
 import os
+import hashlib
+import tempfile
+import threading
+from bisect import bisect_left
+from collections import deque, OrderedDict
 
 
 def _debug(obj):
@@ -11,86 +16,259 @@ def _debug(obj):
     pass
 
 
-def bencode(value):
+def bencode_into(buf, value):
     if isinstance(value, int):
-        return "i" + value + "e"
+        buf += b"i%de" % value
     elif isinstance(value, str):
-        return str(len(value.encode("utf-8"))) + ":" + value
+        data = value.encode("utf-8")
+        buf += b"%d:" % len(data)
+        buf += data
+    elif isinstance(value, (bytes, bytearray)):
+        buf += b"%d:" % len(value)
+        buf += value
     elif isinstance(value, list):
-        return "l" + "".join(map(bencode, value)) + "e"
+        buf += b"l"
+        for x in value:
+            bencode_into(buf, x)
+        buf += b"e"
     elif isinstance(value, dict):
-        enc = ["d"]
-        keys = list(value.keys())
-        keys.sort()
-        for k in keys:
-            enc.append(bencode(k))
-            enc.append(bencode(value[k]))
-        enc.append("e")
-        return "".join(enc)
+        buf += b"d"
+        for k in sorted(value.keys()):
+            bencode_into(buf, k)
+            bencode_into(buf, value[k])
+        buf += b"e"
     else:
-        raise TypeError("can't bencode " + value)
-
-
-def read_socket(sock, n):
-    data = b""
-    rem = n
-    while True:
-        new_data = sock.recv(rem)
-        data += new_data
-        if len(new_data) == 0:
-            if len(data) == 0:
-                raise EOFError()
-            return data
-        rem -= len(new_data)
-
-
-def bdecode(sock, char=None):
-    if char is None:
-        char = read_socket(sock, 1)
-    if char == b"l":
-        _list = []
-        while True:
-            char = read_socket(sock, 1)
-            if char == b"e":
-                return _list
-            _list.append(bdecode(sock, char))
-    elif char == b"d":
-        d = {}
-        while True:
-            char = read_socket(sock, 1)
-            if char == b"e":
-                return d
-            key = bdecode(sock, char)
-            d[key] = bdecode(sock)
-    elif char == b"i":
-        i = b""
-        while True:
-            char = read_socket(sock, 1)
-            if char == b"e":
-                return int(i.decode("utf-8"))
-            i += char
-    elif char.isdigit():
-        i = int(char)
+        raise TypeError("can't bencode " + repr(value))
+    return buf
+
+
+def bencode(value):
+    return bytes(bencode_into(bytearray(), value))
+
+
+class BDecoder:
+    """
+    An incremental bencode decoder. Bytes are received into a reusable buffer
+    with large recv_into() calls and complete messages are framed out of it,
+    instead of issuing one recv() per byte of framing.
+    """
+
+    def __init__(self, sock=None, bufsize=65536):
+        self.sock = sock
+        self.chunk = bytearray(bufsize)
+        self.view = memoryview(self.chunk)
+        self.buf = bytearray()
+        # buffer length required before another parse attempt can succeed
+        self.need = 1
+        self.messages = deque()
+
+    def feed(self, data):
+        self.buf += data
+        if len(self.buf) < self.need:
+            return
+        buf = self.buf
+        pos = 0
+        try:
+            while pos < len(buf):
+                value, pos = self._decode(buf, pos)
+                self.messages.append(value)
+            self.need = 1
+        except _Incomplete as e:
+            self.need = e.need - pos
+        if pos:
+            del buf[:pos]
+
+    def recv(self):
+        """ Receives into self.view, returns the number of bytes received. """
+        n = self.sock.recv_into(self.view)
+        if n == 0:
+            raise EOFError("unexpected end of bdecode data")
+        return n
+
+    def fill(self):
+        n = self.recv()
+        self.feed(self.view[:n])
+
+    def read(self):
+        while not self.messages:
+            self.fill()
+        return self.messages.popleft()
+
+    def __iter__(self):
         while True:
-            char = read_socket(sock, 1)
-            if char == b":":
-                return read_socket(sock, i).decode("utf-8")
-            i = 10 * i + int(char)
-    elif char == "":
-        raise EOFError("unexpected end of bdecode data")
-    else:
-        raise TypeError("unexpected type " + char + "in bdecode data")
-
-
-def get_shadow_primary_target(project_path):
-    path = os.path.join(project_path, "shadow-cljs.edn")
-    with open(path, "r") as f:
-        code = f.read()
-    code = code.replace("\n", " ")
-    idx = code.index(":builds")
-    code = code[idx:]
-    m = re.search(r"\s*(\:[a-zA-Z0-9\-]+)\s*\{\:target\s+\:(browser|node-library|node-script).*", code)
-    if m is None:
+            while self.messages:
+                yield self.messages.popleft()
+            try:
+                self.fill()
+            except EOFError:
+                return
+
+    def _decode(self, buf, pos):
+        n = len(buf)
+        if pos >= n:
+            raise _Incomplete(pos + 1)
+        char = buf[pos]
+        if char == _L:
+            _list = []
+            pos += 1
+            while True:
+                if pos >= n:
+                    raise _Incomplete(pos + 1)
+                if buf[pos] == _E:
+                    return _list, pos + 1
+                value, pos = self._decode(buf, pos)
+                _list.append(value)
+        elif char == _D:
+            d = {}
+            pos += 1
+            while True:
+                if pos >= n:
+                    raise _Incomplete(pos + 1)
+                if buf[pos] == _E:
+                    return d, pos + 1
+                key, pos = self._decode(buf, pos)
+                d[key], pos = self._decode(buf, pos)
+        elif char == _I:
+            end = buf.find(b"e", pos)
+            if end < 0:
+                raise _Incomplete(n + 1)
+            return int(buf[pos + 1:end]), end + 1
+        elif 48 <= char <= 57:
+            colon = buf.find(b":", pos)
+            if colon < 0:
+                raise _Incomplete(n + 1)
+            start = colon + 1
+            end = start + int(buf[pos:colon])
+            if end > n:
+                raise _Incomplete(end)
+            # e.g. binary output, it must not stop the whole stream
+            return buf[start:end].decode("utf-8", errors="replace"), end
+        else:
+            raise TypeError("unexpected type %r in bdecode data" % chr(char))
+
+
+class _Incomplete(Exception):
+    def __init__(self, need):
+        super().__init__(need)
+        self.need = need
+
+
+_L = ord("l")
+_D = ord("d")
+_I = ord("i")
+_E = ord("e")
+
+
+class LRUCache:
+    """ A small thread safe least recently used cache. """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.data:
+                return default
+            self.data.move_to_end(key)
+            return self.data[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def remove_if(self, pred):
+        """ Removes every entry for which pred(key, value) is true. """
+        with self.lock:
+            keys = [k for k, v in self.data.items() if pred(k, v)]
+            for k in keys:
+                del self.data[k]
+            return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+
+class PrefixIndex:
+    """
+    Words kept sorted so that every word with a given prefix is found with a
+    binary search, each word comes with a value.
+    """
+
+    def __init__(self, items):
+        items = sorted(items, key=lambda x: x[0])
+        self.words = [x[0] for x in items]
+        self.values = [x[1] for x in items]
+
+    def search(self, prefix, limit=None):
+        """ [(word, value)] for the words that start with prefix, in order """
+        ret = []
+        i = bisect_left(self.words, prefix)
+        while i < len(self.words) and self.words[i].startswith(prefix):
+            if limit is not None and len(ret) >= limit:
+                break
+            ret.append((self.words[i], self.values[i]))
+            i += 1
+        return ret
+
+    def __len__(self):
+        return len(self.words)
+
+
+def pr_str(s):
+    """ Python string to a (read)-able Clojure string literal """
+    return '"' + s.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def unquote_symbol(form):
+    """
+    Turns a quoted symbol as produced by plasmaplace#quote(), 'foo.bar or
+    (symbol "foo.bar"), back into its name.
+    """
+    if not form:
         return None
-    else:
+    if form.startswith("'"):
+        return form[1:]
+    m = re.match(r'^\(symbol\s+"(.*)"\)$', form)
+    if m is not None:
         return m.group(1)
+    return form
+
+
+def get_project_path(port_file_path, project_type):
+    """ The port file is at the root of the project, or in .shadow-cljs/ """
+    p = os.path.dirname(os.path.abspath(port_file_path))
+    if project_type == "shadow-cljs":
+        p = os.path.normpath(os.path.join(p, ".."))
+    return p
+
+
+def get_history_path(project_path):
+    """ Where the eval history of a project is kept, outside of the project """
+    data_home = os.environ.get("XDG_DATA_HOME")
+    if not data_home:
+        data_home = os.path.join(os.path.expanduser("~"), ".local", "share")
+    digest = hashlib.sha1(project_path.encode("utf-8")).hexdigest()[:16]
+    name = "%s-%s.jsonl" % (os.path.basename(project_path) or "root", digest)
+    return os.path.join(data_home, "plasmaplace", "history", name)
+
+
+def get_daemon_socket_path(project_path):
+    """
+    Where a persistent daemon listens, in the project directory unless that
+    makes the path too long for a Unix domain socket.
+    """
+    path = os.path.join(project_path, ".plasmaplace.sock")
+    if len(path.encode("utf-8")) < 100:
+        return path
+    digest = hashlib.sha1(project_path.encode("utf-8")).hexdigest()[:16]
+    name = "plasmaplace-%d-%s.sock" % (os.getuid(), digest)
+    return os.path.join(tempfile.gettempdir(), name)
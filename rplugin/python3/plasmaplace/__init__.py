@@ -1,7 +1,8 @@
 import sys
 import json
-import select
+import threading
 import subprocess
+from queue import Queue, Empty
 from subprocess import Popen, PIPE, STDOUT
 import pynvim
 
@@ -14,6 +15,9 @@ class Plasmaplace():
         self.msg_id = 1
         self.job_to_process = {}
         self.job_to_cmd = {}
+        # msg_id -> (job_id, Queue) of callers blocked in send_cmd
+        self.waiters = {}
+        self.lock = threading.Lock()
 
     @pynvim.autocmd("BufEnter", pattern="*", eval='expand("<afile>")', sync=True)
     def nop(self, filename):
@@ -25,51 +29,99 @@ class Plasmaplace():
         cmd = list(map(str, cmd))
         job_id = self.job_id
         self.job_id += 1
-        p = Popen(cmd, stdout=PIPE, stdin=PIPE, stderr=PIPE, bufsize=1)
+        p = Popen(cmd, stdout=PIPE, stdin=PIPE, stderr=PIPE)
         self.job_to_process[job_id] = p
+        self.job_to_cmd[job_id] = cmd
+        self._start_read_loop(job_id, p)
         return job_id
 
     def restart_job(self, job_id):
         cmd = self.job_to_cmd[job_id]
-        p = Popen(cmd, stdout=PIPE, stdin=PIPE, stderr=PIPE, bufsize=1)
+        p = Popen(cmd, stdout=PIPE, stdin=PIPE, stderr=PIPE)
         self.job_to_process[job_id] = p
+        self._start_read_loop(job_id, p)
 
+    def _start_read_loop(self, job_id, p):
+        t = threading.Thread(target=self._read_loop, args=(job_id, p), daemon=True)
+        t.start()
+
+    def _read_loop(self, job_id, p):
+        """
+        Runs on its own thread and must not call into nvim directly, replies
+        are handed over to the event loop with async_call.
+        """
+        for line in p.stdout:
+            try:
+                msg_id, msg = json.loads(line.decode("utf-8"))
+            except ValueError:
+                continue
+            with self.lock:
+                waiter = self.waiters.pop(msg_id, None)
+            if waiter is not None:
+                waiter[1].put(msg)
+            else:
+                self.nvim.async_call(self._deliver, job_id, msg)
+        with self.lock:
+            dead = [k for k, (j, _) in self.waiters.items() if j == job_id]
+            waiters = [self.waiters.pop(k) for k in dead]
+        for _, q in waiters:
+            q.put({})
+        self.nvim.async_call(self._job_died, job_id, p)
+
+    def _deliver(self, job_id, msg):
+        self.nvim.call("plasmaplace#_job_callback", job_id, msg)
+
+    def _job_died(self, job_id, p):
+        # jobs that were stopped on purpose are already gone
+        if self.job_to_process.get(job_id) is not p:
+            return
+        del self.job_to_process[job_id]
+        self.nvim.call("plasmaplace#_close_callback", job_id)
 
     @pynvim.function("Plasmaplace_nvim_stop_job", sync=True)
     def stop_job(self, args):
         job_id = args[0]
         if job_id in self.job_to_process:
             p = self.job_to_process[job_id]
-            p.kill()
             del self.job_to_process[job_id]
+            p.kill()
+
+    def _write(self, p, cmd, waiter=None):
+        with self.lock:
+            msg_id = self.msg_id
+            self.msg_id += 1
+            if waiter is not None:
+                self.waiters[msg_id] = waiter
+        msg = json.dumps([msg_id, cmd]) + "\n"
+        p.stdin.write(msg.encode("utf-8"))
+        p.stdin.flush()
+        return msg_id
+
+    @pynvim.function("Plasmaplace_nvim_send_cmd_async", sync=True)
+    def send_cmd_async(self, args):
+        """
+        Only writes the command, the reply is passed to plasmaplace#_job_callback
+        whenever it arrives.
+        """
+        job_id, cmd = args
+        p = self.job_to_process.get(job_id)
+        if p is None or p.poll() is not None:
+            return {"dead": True}
+        self._write(p, cmd)
+        return {}
 
     @pynvim.function("Plasmaplace_nvim_send_cmd", sync=True)
     def send_cmd(self, args):
         job_id, cmd, timeout = args
-        p = self.job_to_process[job_id]
-        is_running = p.poll() is None
-        if not is_running:
+        p = self.job_to_process.get(job_id)
+        if p is None or p.poll() is not None:
             return {"dead": True}
-        msg_id = self.msg_id
-        self.msg_id += 1
-
-        while True:
-            msg = json.dumps([msg_id, cmd])
-            p.stdin.write(msg.encode("utf-8"))
-            p.stdin.write("\n".encode("utf-8"))
-            p.stdin.flush()
-
-            ready, _, _ = select.select([p.stdout], [], [], timeout)
-            if len(ready) == 0:
-                return {"timeout": True}
-            ret = p.stdout.readline()
-
-            if ret is None:
-                return {}
-            ret = ret.decode("utf-8")
-            if not ret:
-                return {}
-            ret_msg_id, ret = json.loads(ret)
-            if ret_msg_id != msg_id:
-                continue
-            return ret
+        q = Queue()
+        msg_id = self._write(p, cmd, (job_id, q))
+        try:
+            # timeout is in milliseconds
+            return q.get(timeout=timeout / 1000.0)
+        except Empty:
+            with self.lock:
+                self.waiters.pop(msg_id, None)
+            return {"timeout": True}
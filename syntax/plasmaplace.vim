@@ -6,6 +6,7 @@ syn match plasmaplace_error /\v^;; ERR/ containedin=ALL
 syn match plasmaplace_error /\v^;; EX/ containedin=ALL
 syn match plasmaplace_error /\v^;; STACKTRACE/ containedin=ALL
 syn match plasmaplace_error /\v^;; UNKNOWN/ containedin=ALL
+syn match plasmaplace_error /\v^;; INTERRUPTED/ containedin=ALL
 
 hi link plasmaplace_out Keyword
 syn match plasmaplace_out /\v^;; OUT/ containedin=ALL